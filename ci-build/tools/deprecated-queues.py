@@ -15,36 +15,134 @@
 # limitations under the License.
 
 import argparse
+import hashlib
+import json
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
+import requests.adapters
+from urllib3.util.retry import Retry
+
+
+def get_session(workers):
+    retry = Retry(total=5, backoff_factor=0.5,
+                  status_forcelist=(429, 500, 502, 503, 504))
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=workers, pool_maxsize=workers, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class CachingClient:
+    """Fetch JSON documents, revalidating a local copy when available.
+
+    Responses are kept in cache_dir along with their ETag and
+    Last-Modified headers; a later request for the same URL is sent as a
+    conditional request and the stored body is reused on 304.
+    """
+
+    def __init__(self, session, cache_dir=None):
+        self.session = session
+        self.cache_dir = cache_dir
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _cache_path(self, url):
+        key = hashlib.sha256(url.encode('utf8')).hexdigest()
+        return os.path.join(self.cache_dir, key + '.json')
+
+    def get(self, url):
+        if not self.cache_dir:
+            r = self.session.get(url)
+            r.raise_for_status()
+            return r.json()
+
+        path = self._cache_path(url)
+        cached = None
+        headers = {}
+        try:
+            with open(path) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            pass
+        if cached:
+            if cached.get('etag'):
+                headers['If-None-Match'] = cached['etag']
+            if cached.get('last_modified'):
+                headers['If-Modified-Since'] = cached['last_modified']
+
+        r = self.session.get(url, headers=headers)
+        if r.status_code == 304 and cached:
+            return cached['body']
+        r.raise_for_status()
+        body = r.json()
+        if r.headers.get('ETag') or r.headers.get('Last-Modified'):
+            # Threads may fetch the same URL at once, so each writes its
+            # own temporary file.
+            fd, tmp = tempfile.mkstemp(dir=self.cache_dir)
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump({'etag': r.headers.get('ETag'),
+                               'last_modified': r.headers.get('Last-Modified'),
+                               'body': body}, f)
+                os.replace(tmp, path)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+        return body
+
+
+def find_queue_contexts(client, url, tenant, project_name):
+    project = client.get(
+        f"{url}/api/tenant/{tenant}/project/{project_name}")
+    contexts = set()
+    for config in project['configs']:
+        for pipeline in config['pipelines']:
+            if pipeline['queue_name']:
+                contexts.add(repr(config['source_context']))
+    return contexts
 
 
 def main():
     parser = argparse.ArgumentParser(
         description="Find where a project declares a queue")
     parser.add_argument("url", help="Zuul URL")
-    parser.add_argument("tenant", help="Zuul tenant name")
+    parser.add_argument("tenant", nargs='?',
+                        help="Zuul tenant name (default: all tenants)")
     parser.add_argument("--verbose", help="Display progress",
                         action='store_true')
+    parser.add_argument("--workers", type=int, default=16,
+                        help="Number of concurrent requests")
+    parser.add_argument("--cache-dir",
+                        help="Directory where API responses are cached "
+                        "between runs")
     args = parser.parse_args()
 
-    projects = requests.get(
-        f'{args.url}/api/tenant/{args.tenant}/projects',
-    ).json()
+    workers = max(args.workers, 1)
+    client = CachingClient(get_session(workers), args.cache_dir)
 
-    pipeline_contexts = set()
-    for tenant_project in projects:
-        if args.verbose:
-            print(f"Checking {tenant_project['name']}")
-        project = requests.get(
-            f"{args.url}/api/tenant/{args.tenant}/project/"
-            f"{tenant_project['name']}",
-        ).json()
-
-        for config in project['configs']:
-            for pipeline in config['pipelines']:
-                if pipeline['queue_name']:
-                    pipeline_contexts.add(repr(config['source_context']))
+    if args.tenant:
+        tenants = [args.tenant]
+    else:
+        tenants = [t['name'] for t in client.get(f'{args.url}/api/tenants')]
 
+    pipeline_contexts = set()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for tenant in tenants:
+            projects = client.get(f'{args.url}/api/tenant/{tenant}/projects')
+            for tenant_project in projects:
+                if args.verbose:
+                    print(f"Checking {tenant} {tenant_project['name']}")
+                futures.append(executor.submit(
+                    find_queue_contexts, client, args.url, tenant,
+                    tenant_project['name']))
+        for f in futures:
+            pipeline_contexts |= f.result()
     if pipeline_contexts:
         print("The following project-pipeline stanzas define a queue.")
         print("This syntax is deprecated and queue definitions should")
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Serve canned Zuul REST API responses for testing the tools in this directory.
+
+Each request path is mapped to a JSON file below the data directory, so that
+``/api/tenant/example/status`` is answered with the content of
+``DATA/api/tenant/example/status.json``.  ``/api/info`` defaults to a
+multi-tenant answer when no file is provided for it.
+
+Example:
+
+    fake-zuul-api.py --port 9000 ./snapshot-data &
+    zuul-changes.py http://localhost:9000 --snapshot queues.jsonl
+"""
+
+import argparse
+import email.utils
+import hashlib
+import json
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+
+class FakeZuulHandler(BaseHTTPRequestHandler):
+    data_dir = None
+
+    def not_modified(self, etag, mtime):
+        # If-None-Match takes precedence over If-Modified-Since
+        if 'If-None-Match' in self.headers:
+            return self.headers['If-None-Match'] == etag
+        since = self.headers.get('If-Modified-Since')
+        if since is None or mtime is None:
+            return False
+        try:
+            since = email.utils.parsedate_to_datetime(since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(mtime) <= since
+
+    def send_json(self, code, body, mtime=None):
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        if code == 200 and self.not_modified(etag, mtime):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('ETag', etag)
+        if mtime is not None:
+            self.send_header('Last-Modified',
+                             email.utils.formatdate(mtime, usegmt=True))
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urlparse(self.path).path.strip('/')
+        fn = os.path.realpath(os.path.join(self.data_dir, path + '.json'))
+        if not fn.startswith(self.data_dir + os.sep):
+            self.send_json(403, b'{}')
+            return
+        if os.path.isfile(fn):
+            with open(fn, 'rb') as f:
+                self.send_json(200, f.read(), os.path.getmtime(fn))
+        elif path == 'api/info':
+            self.send_json(200, json.dumps({'info': {}}).encode('utf8'))
+        else:
+            self.send_json(404, b'{}')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve canned Zuul API responses from a directory")
+    parser.add_argument('data_dir', help='Directory with JSON responses')
+    parser.add_argument('--port', type=int, default=9000,
+                        help='Port to listen on (0 for any free port)')
+    parser.add_argument('--verbose', action='store_true',
+                        help='Log every request')
+    args = parser.parse_args()
+
+    FakeZuulHandler.data_dir = os.path.realpath(args.data_dir)
+    if not args.verbose:
+        FakeZuulHandler.log_message = lambda *a: None
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), FakeZuulHandler)
+    # With --port 0 the kernel picks the port, so print the real one
+    print("Serving %s on http://127.0.0.1:%d" % (
+        FakeZuulHandler.data_dir, server.server_address[1]), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
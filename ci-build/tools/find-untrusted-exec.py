@@ -13,19 +13,43 @@
 # under the License.
 
 import argparse
+import gzip
+import hashlib
+import io
 import json
+import os
 import sys
 import datetime
+import tempfile
 import requests
+import requests.adapters
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DISALLOWED_ACTIONS = ('command', 'shell')
+
 
 def usage(argv):
     two_weeks_ago = datetime.datetime.utcnow() - datetime.timedelta(days=14)
     parser = argparse.ArgumentParser(
-        description="Look for unstrusted command in builds log")
+        description="Look for unstrusted command in builds log",
+        epilog="Install ijson to keep memory usage flat when reading "
+        "large job-output.json files.")
     parser.add_argument(
         "--since", default=two_weeks_ago, help="Date in YYYY-MM-DD format")
+    parser.add_argument(
+        "--workers", type=int, default=8,
+        help="Number of tenants scanned and logs downloaded concurrently")
+    parser.add_argument(
+        "--cache-dir", default="/tmp/zuul-logs", type=Path,
+        help="Where downloaded job-output.json files are kept")
     parser.add_argument("zuul_url", help="The url of a zuul-web service")
     args = parser.parse_args(argv)
 
@@ -37,18 +61,40 @@ def usage(argv):
     return args
 
 
-def get_tenants(zuul_url):
+def get_session(pool_size=16):
+    """ Create a requests session with a connection pool """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_tenants(session, zuul_url):
     """ Fetch list of tenant names """
-    is_witelabel = requests.get(
+    is_witelabel = session.get(
         "%s/info" % zuul_url).json().get('tenant', None) is not None
     if is_witelabel:
         raise RuntimeError("Need multitenant api")
     return [
         tenant["name"]
-        for tenant in requests.get("%s/tenants" % zuul_url).json()
+        for tenant in session.get("%s/tenants" % zuul_url).json()
     ]
 
 
+def get_job_names(session, zuul_tenant_url):
+    """ Fetch the set of job names defined in a tenant """
+    try:
+        r = session.get("%s/jobs" % zuul_tenant_url)
+        r.raise_for_status()
+        return set(job["name"] for job in r.json())
+    except Exception:
+        # Without the job list we can't stop early, but the scan
+        # itself is still valid.
+        return None
+
+
 def is_build_in_range(build, since):
     """ Check if a build is in range """
     try:
@@ -59,94 +105,274 @@ def is_build_in_range(build, since):
         return False
 
 
-def get_builds(zuul_builds_url, since):
-    """ Fecth list of builds that are in range """
-    builds = []
+def get_builds(session, zuul_builds_url, since, step=500):
+    """ Yield builds that are in range, one page at a time """
     pos = 0
-    step = 50
-    while not builds or is_build_in_range(builds[-1], since):
+    while True:
         url = "%s?skip=%d&limit=%d" % (zuul_builds_url, pos, step)
         print("Querying %s" % url)
-        builds += requests.get(url).json()
+        r = session.get(url)
+        # An error must not pass for the end of the builds
+        r.raise_for_status()
+        page = r.json()
+        for build in page:
+            if not build.get("start_time"):
+                # SKIPPED and NODE_FAILURE builds never started, they
+                # say nothing about where the range ends.
+                continue
+            if not is_build_in_range(build, since):
+                return
+            yield build
+        if len(page) < step:
+            return
         pos += step
-    return builds
 
 
-def filter_unique_builds(builds):
-    """ Filter the list of build to keep only one per job name """
+def get_unique_builds(session, zuul_tenant_url, since):
+    """ Keep only the most recent build of each job name
+
+    The scan stops as soon as a build of every job in the tenant has
+    been found.  That is only a shortcut: it doesn't happen unless every
+    job ran since the start of the range, otherwise the whole range is
+    scanned.
+    """
+    job_names = get_job_names(session, zuul_tenant_url)
     jobs = dict()
-    for build in builds:
+    for build in get_builds(session, zuul_tenant_url + "/builds", since):
         if build["job_name"] not in jobs:
             jobs[build["job_name"]] = build
+            if job_names is not None and job_names.issubset(jobs):
+                break
     unique_builds = list(jobs.values())
-    print("Found %d unique job builds" % len(unique_builds))
+    print("Found %d unique job builds in %s" % (
+        len(unique_builds), zuul_tenant_url))
     return unique_builds
 
 
-def download(source_url, local_filename):
-    """ Download a file using streaming request """
-    with requests.get(source_url, local_filename, stream=True) as r:
-        r.raise_for_status()
-        with open(local_filename, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=8192):
-                f.write(chunk)
+class BuildCache:
+    """ Content-addressed store of downloaded job-output.json files
+
+    Files are stored under objects/ by the sha256 of their (possibly
+    gzip-compressed) content, and builds/ maps a build uuid to the
+    content digest, so a build log is never downloaded twice.
+    """
+
+    def __init__(self, path):
+        self.objects = path / "objects"
+        self.builds = path / "builds"
+        self.objects.mkdir(parents=True, exist_ok=True)
+        self.builds.mkdir(parents=True, exist_ok=True)
 
+    def lookup(self, uuid):
+        try:
+            digest = (self.builds / uuid).read_text().strip()
+        except FileNotFoundError:
+            return None
+        path = self.objects / digest
+        if path.exists():
+            return path
+        return None
 
-def download_build_job_output(zuul_build_url, local_path):
-    """ Download the job-output.json of a build """
-    build = requests.get(zuul_build_url).json()
-    if not build.get("log_url"):
-        return "No log url"
+    def store(self, uuid, response):
+        """ Save a streamed response body and return its path """
+        digest = hashlib.sha256()
+        fd, tmp = tempfile.mkstemp(dir=str(self.objects))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                # Keep the content as it was sent: gzip-encoded responses
+                # stay compressed on disk and are decompressed on read.
+                for chunk in response.raw.stream(DOWNLOAD_CHUNK_SIZE,
+                                                 decode_content=False):
+                    digest.update(chunk)
+                    f.write(chunk)
+            path = self.objects / digest.hexdigest()
+            os.replace(tmp, str(path))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        (self.builds / uuid).write_text(digest.hexdigest())
+        return path
+
+
+def download_build_job_output(session, cache, zuul_build_url, uuid):
+    """ Fetch the job-output.json of a build, unless it is cached
+
+    Returns a (path, error) tuple.
+    """
+    path = cache.lookup(uuid)
+    if path:
+        return path, None
     try:
-        download(build["log_url"] + "job-output.json", local_path)
+        build = session.get(zuul_build_url).json()
+        if not build.get("log_url"):
+            return None, "No log url"
+        for name in ("job-output.json", "job-output.json.gz"):
+            with session.get(build["log_url"] + name, stream=True,
+                             headers={"Accept-Encoding": "gzip"}) as r:
+                if r.status_code == 404:
+                    continue
+                r.raise_for_status()
+                return cache.store(uuid, r), None
+        return None, "No job-output.json"
     except Exception as e:
-        return str(e)
+        return None, str(e)
+
+
+def open_job_output(path):
+    """ Open a cached job output, decompressing it if needed """
+    f = open(path, 'rb')
+    if f.read(2) == b'\x1f\x8b':
+        f.close()
+        return gzip.open(path, 'rb')
+    f.seek(0)
+    return f
+
+
+def _iter_array_items(f, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """ Decode the elements of a top-level JSON array one at a time
+
+    Each element is decoded whole, so memory use depends on the size of
+    the largest one.
+    """
+    decoder = json.JSONDecoder()
+    reader = io.TextIOWrapper(f, encoding='utf8')
+    buf = ''
+    eof = False
+    started = False
+    while True:
+        buf = buf.lstrip()
+        if not started and buf:
+            if not buf.startswith('['):
+                raise ValueError("Expected a JSON list")
+            buf = buf[1:]
+            started = True
+            continue
+        if started and buf.startswith(','):
+            buf = buf[1:]
+            continue
+        if started and buf.startswith(']'):
+            return
+        item = end = None
+        if started and buf:
+            try:
+                item, end = decoder.raw_decode(buf)
+            except ValueError:
+                if eof:
+                    raise
+        # A number could go on in the next chunk
+        if end is None or (end == len(buf) and not eof):
+            if eof:
+                raise ValueError("Unterminated JSON list")
+            more = reader.read(max(chunk_size, len(buf)))
+            eof = not more
+            buf += more
+            continue
+        yield item
+        buf = buf[end:]
+
+
+def _scan_with_json(f):
+    for playbook in _iter_array_items(f):
+        tasks = []
+        for play in playbook.get('plays', []):
+            for task in play.get('tasks', []):
+                host = task.get('hosts', {}).get('localhost')
+                if host and host.get('action') in DISALLOWED_ACTIONS:
+                    tasks.append((task.get('role', {}).get('name'),
+                                  task.get('task', {}).get('name')))
+        yield playbook.get('playbook'), playbook.get('trusted'), tasks
+
+
+def _scan_with_ijson(f):
+    task_prefix = 'item.plays.item.tasks.item'
+    playbook = trusted = None
+    tasks = []
+    role = name = action = None
+    for prefix, event, value in ijson.parse(f):
+        if prefix == 'item.playbook':
+            playbook = value
+        elif prefix == 'item.trusted':
+            trusted = value
+        elif prefix == task_prefix + '.role.name':
+            role = value
+        elif prefix == task_prefix + '.task.name':
+            name = value
+        elif prefix == task_prefix + '.hosts.localhost.action':
+            action = value
+        elif prefix == task_prefix and event == 'end_map':
+            if action in DISALLOWED_ACTIONS:
+                tasks.append((role, name))
+            role = name = action = None
+        elif prefix == 'item' and event == 'end_map':
+            yield playbook, trusted, tasks
+            playbook = trusted = None
+            tasks = []
+
+
+def scan(f):
+    """ Yield (playbook, trusted, [(role, task), ...]) for each playbook
+
+    The listed tasks are those running a disallowed action on localhost.
+    With ijson installed, the file is processed as a stream so that
+    memory usage does not depend on its size.  Without it, the file is
+    still read one playbook at a time, but each playbook is decoded at
+    once, and one playbook is often most of the file.
+    """
+    if ijson is not None:
+        return _scan_with_ijson(f)
+    return _scan_with_json(f)
 
 
 def examine(path):
     """ Look for forbidden tasks in  a job-output.json file path """
-    data = json.load(open(path))
     to_fix = False
-    for playbook in data:
-        if playbook['trusted']:
-            continue
-        for play in playbook['plays']:
-            for task in play['tasks']:
-                for hostname, host in task['hosts'].items():
-                    if hostname != 'localhost':
-                        continue
-                    if host['action'] in ['command', 'shell']:
-                        print("Found disallowed task:")
-                        print("  Playbook: %s" % playbook['playbook'])
-                        print("  Role: %s" % task.get('role', {}).get('name'))
-                        print("  Task: %s" % task.get('task', {}).get('name'))
-                        to_fix = True
+    with open_job_output(path) as f:
+        for playbook, trusted, tasks in scan(f):
+            if trusted:
+                continue
+            for role, task in tasks:
+                print("Found disallowed task:")
+                print("  Playbook: %s" % playbook)
+                print("  Role: %s" % role)
+                print("  Task: %s" % task)
+                to_fix = True
     return to_fix
 
 
 def main(argv):
     args = usage(argv)
-    cache_dir = Path("/tmp/zuul-logs")
-    if not cache_dir.exists():
-        cache_dir.mkdir()
+    cache = BuildCache(args.cache_dir)
+    workers = max(args.workers, 1)
+
+    session = get_session(workers * 2)
+    tenant_urls = [
+        args.zuul_url + "/tenant/" + tenant
+        for tenant in get_tenants(session, args.zuul_url)]
 
     to_fix = set()
     failed_to_examine = set()
-    for tenant in get_tenants(args.zuul_url):
-        zuul_tenant_url = args.zuul_url + "/tenant/" + tenant
-        print("Looking for unique build in %s" % zuul_tenant_url)
-        for build in filter_unique_builds(
-                get_builds(zuul_tenant_url + "/builds", args.since)):
-            if not build.get("uuid"):
-                # Probably a SKIPPED build, no need to examine
-                continue
-            local_path = cache_dir / (build["uuid"] + ".json")
-            build_url = zuul_tenant_url + "/build/" + build["uuid"]
-            if not local_path.exists():
-                err = download_build_job_output(build_url, str(local_path))
-                if err:
-                    failed_to_examine.add((build_url, err))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        tenant_builds = list(executor.map(
+            lambda url: get_unique_builds(session, url, args.since),
+            tenant_urls))
+
+        futures = {}
+        for zuul_tenant_url, builds in zip(tenant_urls, tenant_builds):
+            for build in builds:
+                if not build.get("uuid"):
+                    # Probably a SKIPPED build, no need to examine
                     continue
+                build_url = zuul_tenant_url + "/build/" + build["uuid"]
+                f = executor.submit(download_build_job_output,
+                                    session, cache, build_url, build["uuid"])
+                futures[f] = build_url
+
+        for f in as_completed(futures):
+            build_url = futures[f]
+            local_path, err = f.result()
+            if err:
+                failed_to_examine.add((build_url, err))
+                continue
             try:
                 if not examine(str(local_path)):
                     print("%s: ok" % build_url)
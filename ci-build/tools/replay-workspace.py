@@ -18,6 +18,8 @@ import os
 import subprocess
 import logging
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 parser = argparse.ArgumentParser(
     description="Replay the Zuul workspace repo setup using information "
@@ -25,6 +27,16 @@ parser = argparse.ArgumentParser(
 parser.add_argument('file', help='Path to workspace-repos.json')
 parser.add_argument('-v', action='store_true', help='Verbose logging')
 parser.add_argument('--workspace', help='Path to workspace')
+parser.add_argument('--workers', type=int, default=8,
+                    help='Number of repos processed in parallel')
+parser.add_argument('--mirror',
+                    help='Root of a local mirror cache used to create '
+                    'missing repos (e.g. /opt/git)')
+parser.add_argument('--mirror-mode', choices=['shared', 'hardlink'],
+                    default='shared',
+                    help='Borrow objects from the mirror through git '
+                    'alternates (shared) or hardlink its object store '
+                    '(hardlink)')
 options = parser.parse_args()
 
 if options.v:
@@ -38,18 +50,37 @@ class CloneException(Exception):
 
 
 class Workspace:
-    def __init__(self, path):
+    def __init__(self, path, workers=1, mirror=None, mirror_mode='shared'):
         self.path = path
+        self.workers = max(workers, 1)
+        self.mirror = mirror
+        self.mirror_mode = mirror_mode
+        self.timings = {}
         self.log = logging.getLogger('workspace')
 
-    def run(self, cmd, cwd, timestamp=None, level=logging.INFO):
+    def run(self, cmd, cwd, timestamp=None, level=logging.INFO, input=None):
         self.log.log(level, 'Run: "%s"', ' '.join(cmd))
         env = self.env
         if timestamp:
             env = env.copy()
             env['GIT_COMMITTER_DATE'] = str(int(timestamp)) + '+0000'
             env['GIT_AUTHOR_DATE'] = str(int(timestamp)) + '+0000'
-        subprocess.run(cmd, cwd=cwd, env=env, check=True)
+        subprocess.run(cmd, cwd=cwd, env=env, check=True, input=input)
+
+    def for_each_repo(self, name, func, items):
+        # Run func(repo, item) for every repo in parallel, recording how
+        # long each one took under the given step name.
+        def timed(repo, item):
+            start = time.monotonic()
+            func(repo, item)
+            timings = self.timings.setdefault(repo, {})
+            timings[name] = time.monotonic() - start
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(timed, repo, item)
+                       for repo, item in items.items()]
+            for f in futures:
+                f.result()
 
     def load(self, fn):
         with open(fn) as f:
@@ -61,29 +92,58 @@ class Workspace:
         self.env = {
             'GIT_AUTHOR_NAME': self.merge_name,
             'GIT_AUTHOR_EMAIL': self.merge_email,
-            'GIT_COMITTER_NAME': self.merge_name,
-            'GIT_COMITTER_EMAIL': self.merge_email,
+            'GIT_COMMITTER_NAME': self.merge_name,
+            'GIT_COMMITTER_EMAIL': self.merge_email,
         }
 
+    def clone_repo(self, repo, path):
+        source = self.mirror and os.path.abspath(
+            os.path.join(self.mirror, repo))
+        if not (source and os.path.isdir(source)):
+            raise CloneException()
+        # Local clones hardlink the object store by default; --shared
+        # uses alternates instead so nothing is copied at all.
+        cmd = ['git', 'clone', '--quiet', '--no-checkout']
+        if self.mirror_mode == 'shared':
+            cmd.append('--shared')
+        cmd += [source, os.path.abspath(path)]
+        self.run(cmd, cwd=self.path)
+
     def clone(self):
-        for repo, state in self.repo_state.items():
+        missing = {}
+        for repo in self.repo_state:
             path = os.path.join(self.path, repo)
-            fail = False
             if not os.path.exists(path):
-                self.log.error("Please clone the repo %s", repo)
-                fail = True
-            if fail:
-                raise CloneException()
+                missing[repo] = path
+
+        failed = []
+
+        def clone_or_fail(repo, path):
+            try:
+                self.clone_repo(repo, path)
+            except (CloneException, subprocess.CalledProcessError):
+                failed.append(repo)
+
+        self.for_each_repo('clone', clone_or_fail, missing)
+        for repo in sorted(failed):
+            self.log.error("Please clone the repo %s", repo)
+        if failed:
+            raise CloneException()
+
+    def reset_repo(self, repo, state):
+        # Apply all refs of the repo in a single git process
+        path = os.path.join(self.path, repo)
+        commands = ''.join('update %s %s\n' % (ref, sha)
+                           for ref, sha in state.items())
+        self.log.debug('Updating %d refs in %s', len(state), repo)
+        self.run(['git', 'update-ref', '--stdin'], cwd=path,
+                 level=logging.DEBUG, input=commands.encode('utf8'))
 
     def reset(self):
-        for repo, state in self.repo_state.items():
-            path = os.path.join(self.path, repo)
-            for ref, sha in state.items():
-                self.run(['git', 'update-ref', ref, sha],
-                         cwd=path, level=logging.DEBUG)
+        self.for_each_repo('reset', self.reset_repo, self.repo_state)
 
-    def replay(self):
-        for op in self.merge_ops:
+    def replay_repo(self, repo, ops):
+        for op in ops:
             if 'cmd' in op:
                 self.run(op['cmd'],
                          cwd=os.path.join(self.path, op['path']),
@@ -91,8 +151,32 @@ class Workspace:
             if 'comment' in op:
                 self.log.info(op['comment'])
 
+    def replay(self):
+        # Operations on different repos are independent, so each repo's
+        # sequence is replayed in its own thread.  Comments without a
+        # path are kept with the next operation that has one.
+        ops_by_repo = {}
+        pending = []
+        for op in self.merge_ops:
+            if 'path' not in op:
+                pending.append(op)
+                continue
+            ops_by_repo.setdefault(op['path'], []).extend(pending + [op])
+            pending = []
+        self.for_each_repo('replay', self.replay_repo, ops_by_repo)
+        for op in pending:
+            if 'comment' in op:
+                self.log.info(op['comment'])
+
+    def report(self):
+        for repo, timings in sorted(self.timings.items()):
+            self.log.info('%s: %s', repo, ', '.join(
+                '%s %.3fs' % (name, elapsed)
+                for name, elapsed in sorted(timings.items())))
+
 
-w = Workspace(options.workspace or os.getcwd())
+w = Workspace(options.workspace or os.getcwd(), options.workers,
+              options.mirror, options.mirror_mode)
 w.load(options.file)
 try:
     w.clone()
@@ -100,3 +184,4 @@ except CloneException:
     sys.exit(1)
 w.reset()
 w.replay()
+w.report()
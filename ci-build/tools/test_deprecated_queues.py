@@ -0,0 +1,96 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import importlib.util
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import fixtures
+import requests
+import testtools
+
+from test_zuul_changes import FakeZuulAPI
+
+
+spec = importlib.util.spec_from_file_location(
+    'deprecated_queues',
+    os.path.join(os.path.dirname(__file__), 'deprecated-queues.py'))
+deprecated_queues = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(deprecated_queues)
+
+
+class RecordingSession(requests.Session):
+    def __init__(self):
+        super(RecordingSession, self).__init__()
+        self.requests = []
+
+    def get(self, url, **kw):
+        r = super(RecordingSession, self).get(url, **kw)
+        self.requests.append((kw.get('headers', {}), r.status_code))
+        return r
+
+
+class TestCachingClient(testtools.TestCase):
+    def setUp(self):
+        super(TestCachingClient, self).setUp()
+        self.api = self.useFixture(FakeZuulAPI({
+            'api/tenants': [{'name': 'tenant-one'}],
+        }))
+        self.url = self.api.url + '/api/tenants'
+        self.cache_dir = self.useFixture(fixtures.TempDir()).path
+        self.session = RecordingSession()
+        self.addCleanup(self.session.close)
+        self.client = deprecated_queues.CachingClient(self.session,
+                                                      self.cache_dir)
+
+    def test_etag(self):
+        self.assertEqual([{'name': 'tenant-one'}], self.client.get(self.url))
+        self.assertEqual([{'name': 'tenant-one'}], self.client.get(self.url))
+        (headers1, status1), (headers2, status2) = self.session.requests
+        self.assertEqual(({}, 200), (headers1, status1))
+        self.assertIn('If-None-Match', headers2)
+        self.assertEqual(304, status2)
+
+        # A change on the server is picked up
+        with open(os.path.join(self.api.data_dir, 'api',
+                               'tenants.json'), 'w') as f:
+            json.dump([{'name': 'tenant-two'}], f)
+        self.assertEqual([{'name': 'tenant-two'}], self.client.get(self.url))
+        self.assertEqual(200, self.session.requests[-1][1])
+        self.assertEqual([{'name': 'tenant-two'}], self.client.get(self.url))
+        self.assertEqual(304, self.session.requests[-1][1])
+
+    def test_last_modified(self):
+        self.client.get(self.url)
+        # Keep only the Last-Modified header of the cached response
+        path = self.client._cache_path(self.url)
+        with open(path) as f:
+            cached = json.load(f)
+        self.assertIsNotNone(cached['last_modified'])
+        cached['etag'] = None
+        with open(path, 'w') as f:
+            json.dump(cached, f)
+        self.assertEqual([{'name': 'tenant-one'}], self.client.get(self.url))
+        headers, status = self.session.requests[-1]
+        self.assertEqual({'If-Modified-Since': cached['last_modified']},
+                         headers)
+        self.assertEqual(304, status)
+
+    def test_concurrent(self):
+        # Threads fetching the same URL must not share a temporary file
+        with ThreadPoolExecutor(8) as executor:
+            results = list(executor.map(
+                lambda i: self.client.get(self.url), range(32)))
+        self.assertEqual([[{'name': 'tenant-one'}]] * 32, results)
+        self.assertEqual([os.path.basename(
+            self.client._cache_path(self.url))], os.listdir(self.cache_dir))
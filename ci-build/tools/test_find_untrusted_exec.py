@@ -0,0 +1,195 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import datetime
+import gzip
+import importlib.util
+import io
+import json
+import os
+import pathlib
+
+import fixtures
+import requests
+import testtools
+
+
+spec = importlib.util.spec_from_file_location(
+    'find_untrusted_exec',
+    os.path.join(os.path.dirname(__file__), 'find-untrusted-exec.py'))
+find_untrusted_exec = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(find_untrusted_exec)
+
+
+class FakeResponse:
+    def __init__(self, data, status_code=200):
+        self.data = data
+        self.status_code = status_code
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError("%d Error" % self.status_code)
+
+    def json(self):
+        return self.data
+
+
+class FakeSession:
+    def __init__(self, builds, fail_at=None):
+        self.builds = builds
+        self.fail_at = fail_at
+        self.urls = []
+
+    def get(self, url):
+        self.urls.append(url)
+        query = dict(arg.split('=') for arg in url.split('?')[1].split('&'))
+        skip, limit = int(query['skip']), int(query['limit'])
+        if skip == self.fail_at:
+            return FakeResponse('<html>Bad gateway</html>', 502)
+        return FakeResponse(self.builds[skip:skip + limit])
+
+
+class TestGetBuilds(testtools.TestCase):
+    def test_null_start_time(self):
+        def build(uuid, day):
+            start_time = None
+            if day is not None:
+                start_time = '2020-01-%02dT00:00:00' % day
+            return dict(uuid=uuid, start_time=start_time)
+
+        session = FakeSession([
+            build('a', 20),
+            build('b', None),
+            build('c', 19),
+            build('d', None),
+            build('e', 18),
+            build('f', 5),
+            build('g', 4),
+        ])
+        since = datetime.datetime(2020, 1, 10)
+        builds = find_untrusted_exec.get_builds(
+            session, 'http://zuul/api/tenant/t/builds', since, step=3)
+        self.assertEqual(['a', 'c', 'e'], [b['uuid'] for b in builds])
+        # The scan stops at the first build older than since
+        self.assertEqual(2, len(session.urls))
+
+    def test_server_error(self):
+        builds = [dict(uuid=str(i), start_time='2020-01-20T00:00:00')
+                  for i in range(5)]
+        session = FakeSession(builds, fail_at=3)
+        since = datetime.datetime(2020, 1, 10)
+        builds = find_untrusted_exec.get_builds(
+            session, 'http://zuul/api/tenant/t/builds', since, step=3)
+        self.assertEqual(['0', '1', '2'],
+                         [next(builds)['uuid'] for i in range(3)])
+        self.assertRaises(requests.HTTPError, next, builds)
+
+
+def playbook(name, trusted, tasks):
+    return dict(playbook=name, trusted=trusted, plays=[dict(tasks=[
+        dict(role=dict(name=role), task=dict(name=task),
+             hosts=dict(localhost=dict(action=action)))
+        for role, task, action in tasks])])
+
+
+JOB_OUTPUT = [
+    playbook('trusted/pre.yaml', True, [
+        ('prepare', 'Run setup', 'command'),
+    ]),
+    playbook('untrusted/run.yaml', False, [
+        ('build', 'Say "hi", then ] and [', 'shell'),
+        ('build', 'Copy\\ files', 'copy'),
+        (None, 'Run, "quoted" \\"escaped\\" ]', 'command'),
+    ]),
+    playbook('untrusted/post.yaml', False, []),
+]
+
+
+class TestScan(testtools.TestCase):
+    def test_iter_array_items(self):
+        data = [
+            {'name': 'a ] b', 'value': ',', 'quote': 'say \\"]\\", ok'},
+            [1, 2, [3, ']']],
+            12345,
+            'string, with ] inside',
+            {'nested': {'list': [{'x': ']'}, '\\\\']}},
+            123.5e3,
+        ]
+        text = '  \n [ ' + ' ,\n '.join(json.dumps(x) for x in data) + ' ] \n'
+        for chunk_size in (1, 7, 4096):
+            items = list(find_untrusted_exec._iter_array_items(
+                io.BytesIO(text.encode('utf8')), chunk_size))
+            self.assertEqual(data, items, chunk_size)
+
+    def test_iter_array_items_errors(self):
+        for text in ('{"a": 1}', '[{"a": 1}, {"b"', ''):
+            self.assertRaises(ValueError, list,
+                              find_untrusted_exec._iter_array_items(
+                                  io.BytesIO(text.encode('utf8')), 7))
+
+    def test_scanners(self):
+        data = json.dumps(JOB_OUTPUT, indent=2).encode('utf8')
+        expected = [
+            ('trusted/pre.yaml', True, [('prepare', 'Run setup')]),
+            ('untrusted/run.yaml', False, [
+                ('build', 'Say "hi", then ] and ['),
+                (None, 'Run, "quoted" \\"escaped\\" ]')]),
+            ('untrusted/post.yaml', False, []),
+        ]
+        self.assertEqual(expected, list(
+            find_untrusted_exec._scan_with_json(io.BytesIO(data))))
+        self.assertEqual(expected, list(
+            find_untrusted_exec._scan_with_ijson(io.BytesIO(data))))
+
+
+class FakeRaw:
+    def __init__(self, data):
+        self.data = data
+
+    def stream(self, chunk_size, decode_content=True):
+        for i in range(0, len(self.data), 3):
+            yield self.data[i:i + 3]
+
+
+class FakeStreamResponse:
+    def __init__(self, data):
+        self.raw = FakeRaw(data)
+
+
+class TestBuildCache(testtools.TestCase):
+    def setUp(self):
+        super(TestBuildCache, self).setUp()
+        self.cache = find_untrusted_exec.BuildCache(pathlib.Path(
+            self.useFixture(fixtures.TempDir()).path) / 'cache')
+
+    def test_store_lookup(self):
+        data = json.dumps(JOB_OUTPUT).encode('utf8')
+        self.assertIsNone(self.cache.lookup('uuid1'))
+        path1 = self.cache.store('uuid1', FakeStreamResponse(data))
+        path2 = self.cache.store('uuid2', FakeStreamResponse(data))
+        self.assertEqual(path1, path2)
+        self.assertEqual(path1, self.cache.lookup('uuid1'))
+        self.assertEqual(path1, self.cache.lookup('uuid2'))
+        self.assertEqual([path1.name], os.listdir(str(self.cache.objects)))
+        self.assertEqual(data, path1.read_bytes())
+
+    def test_open_job_output(self):
+        data = json.dumps(JOB_OUTPUT).encode('utf8')
+        plain = self.cache.store('plain', FakeStreamResponse(data))
+        compressed = self.cache.store(
+            'gzip', FakeStreamResponse(gzip.compress(data)))
+        self.assertNotEqual(plain, compressed)
+        for uuid in ('plain', 'gzip'):
+            path = self.cache.lookup(uuid)
+            with find_untrusted_exec.open_job_output(str(path)) as f:
+                self.assertEqual(data, f.read())
+            self.assertTrue(find_untrusted_exec.examine(str(path)))
@@ -0,0 +1,145 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+import fixtures
+import testtools
+
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPOS = ('example.com/org/one', 'example.com/org/two')
+
+
+def git(path, *args):
+    return subprocess.run(
+        ('git',) + args, cwd=path, check=True, stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT).stdout.decode('utf8').strip()
+
+
+class TestReplayWorkspace(testtools.TestCase):
+    def setUp(self):
+        super(TestReplayWorkspace, self).setUp()
+        self.root = self.useFixture(fixtures.TempDir()).path
+        self.workspace = os.path.join(self.root, 'workspace')
+        self.repo_state = {}
+        for repo in REPOS:
+            path = os.path.join(self.workspace, repo)
+            os.makedirs(path)
+            git(path, 'init', '-q', '-b', 'master')
+            git(path, '-c', 'user.name=Zuul', '-c', 'user.email=z@example.com',
+                'commit', '-q', '--allow-empty', '-m', 'base')
+            base = git(path, 'rev-parse', 'HEAD')
+            git(path, '-c', 'user.name=Zuul', '-c', 'user.email=z@example.com',
+                'commit', '-q', '--allow-empty', '-m', 'change')
+            change = git(path, 'rev-parse', 'HEAD')
+            # The zuul refs only exist once the state is reset
+            self.repo_state[repo] = {
+                'refs/heads/master': base,
+                'refs/zuul/change': change,
+                'refs/tags/base': base,
+            }
+
+    def _ops(self):
+        # The ops of both repos, interleaved
+        ops = [{'comment': 'Preparing the workspace'}]
+        for step in ('one', 'two', 'three'):
+            for repo in REPOS:
+                ops.append({'comment': 'Step %s in %s' % (step, repo)})
+                ops.append({'path': repo, 'timestamp': 1700000000,
+                            'cmd': ['git', 'commit', '-q', '--allow-empty',
+                                    '-m', step]})
+        ops.insert(1, {'path': REPOS[0],
+                       'cmd': ['git', 'merge', '-q', '--ff-only',
+                               'refs/zuul/change']})
+        return ops
+
+    def _run(self, *args):
+        fn = os.path.join(self.root, 'workspace-repos.json')
+        with open(fn, 'w') as f:
+            json.dump({'repo_state': self.repo_state,
+                       'merge_ops': self._ops(),
+                       'merge_name': 'Zuul Merger',
+                       'merge_email': 'merger@example.com'}, f)
+        return subprocess.run(
+            [sys.executable, os.path.join(TOOLS_DIR, 'replay-workspace.py'),
+             '-v', '--workspace', self.workspace, '--workers', '2', fn] +
+            list(args),
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=True,
+            universal_newlines=True).stdout
+
+    def _check(self):
+        for repo in REPOS:
+            path = os.path.join(self.workspace, repo)
+            for ref, sha in self.repo_state[repo].items():
+                if ref != 'refs/heads/master':
+                    self.assertEqual(sha, git(path, 'rev-parse', ref))
+            expected = ['three', 'two', 'one']
+            if repo == REPOS[0]:
+                expected += ['change']
+            self.assertEqual(expected + ['base'], git(
+                path, 'log', '--format=%s', 'master').splitlines())
+            # replay-workspace.py runs git without HOME, so the merger
+            # identity is all there is
+            self.assertEqual('Zuul Merger <merger@example.com>', git(
+                path, 'log', '-1', '--format=%cn <%ce>', 'master'))
+
+    def test_replay(self):
+        out = self._run()
+        self._check()
+        # One update-ref process per repo for all of its refs
+        self.assertEqual(2, out.count('Run: "git update-ref --stdin"'))
+        self.assertIn('Updating 3 refs in %s' % (REPOS[0],), out)
+        self.assertIn('Step three in %s' % (REPOS[1],), out)
+
+    def _make_mirror(self):
+        # Bare mirrors of the repos, which are then missing from the
+        # workspace
+        mirror = os.path.join(self.root, 'mirror')
+        for repo in REPOS:
+            path = os.path.join(self.workspace, repo)
+            git(self.root, 'clone', '-q', '--mirror', path,
+                os.path.join(mirror, repo))
+        return mirror
+
+    def _test_mirror(self, mode):
+        mirror = self._make_mirror()
+        for repo in REPOS:
+            shutil.rmtree(os.path.join(self.workspace, repo))
+        out = self._run('--mirror', mirror, '--mirror-mode', mode)
+        for repo in REPOS:
+            path = os.path.join(self.workspace, repo)
+            alternates = os.path.join(path, '.git', 'objects', 'info',
+                                      'alternates')
+            if mode == 'shared':
+                with open(alternates) as f:
+                    self.assertEqual(
+                        os.path.join(mirror, repo, 'objects'),
+                        f.read().strip())
+            else:
+                self.assertFalse(os.path.exists(alternates))
+            # Nothing was checked out
+            self.assertEqual([], git(path, 'ls-files').splitlines())
+        self.assertEqual(2, out.count('Run: "git clone --quiet '
+                                      '--no-checkout'))
+        # The replayed refs resolve to the mirrored commits
+        self._check()
+
+    def test_mirror_shared(self):
+        self._test_mirror('shared')
+
+    def test_mirror_hardlink(self):
+        self._test_mirror('hardlink')
@@ -0,0 +1,195 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+import os
+import subprocess
+import sys
+
+import fixtures
+import testtools
+
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class FakeZuulAPI(fixtures.Fixture):
+    """Run fake-zuul-api.py on a free port, serving the responses in
+    data, a {path: json data} dict.
+
+    """
+    def __init__(self, data):
+        super(FakeZuulAPI, self).__init__()
+        self.data = data
+
+    def _setUp(self):
+        self.data_dir = self.useFixture(fixtures.TempDir()).path
+        for path, data in self.data.items():
+            fn = os.path.join(self.data_dir, path + '.json')
+            os.makedirs(os.path.dirname(fn), exist_ok=True)
+            with open(fn, 'w') as f:
+                json.dump(data, f)
+        self.proc = subprocess.Popen(
+            [sys.executable, os.path.join(TOOLS_DIR, 'fake-zuul-api.py'),
+             '--port', '0', self.data_dir],
+            stdout=subprocess.PIPE, universal_newlines=True)
+        self.addCleanup(self.proc.wait)
+        self.addCleanup(self.proc.terminate)
+        # "Serving <dir> on <url>"
+        self.url = self.proc.stdout.readline().split()[-1]
+
+
+def change(project, id, live=True, ref='refs/heads/master'):
+    return dict(project_canonical=project, id=id, live=live, ref=ref)
+
+
+STATUS = {
+    'api/tenants': [{'name': 'tenant-one'}, {'name': 'tenant-two'}],
+    'api/tenant/tenant-one/status': {'pipelines': [
+        {'name': 'gate', 'change_queues': [
+            {'name': 'integrated', 'heads': [
+                [change('example.com/org/nova', '100,1'),
+                 change('example.com/org/nova', '101,2', live=False),
+                 change('example.com/org/glance', '102,3')],
+            ]},
+            {'name': 'other', 'heads': [
+                [change('example.com/org/docs', '103,1')],
+            ]},
+        ]},
+        {'name': 'post', 'change_queues': [
+            {'name': None, 'heads': [
+                [change('example.com/org/nova', 'abcdef'),
+                 change('example.com/org/nova', None,
+                        ref='refs/tags/1.0')],
+            ]},
+        ]},
+    ]},
+    'api/tenant/tenant-two/status': {'pipelines': [
+        {'name': 'check', 'change_queues': [
+            {'name': None, 'heads': [
+                [change('example.com/org/ansible', '200,4')],
+                [change('example.com/org/zuul', '201,1')],
+            ]},
+        ]},
+    ]},
+}
+
+
+class TestZuulChanges(testtools.TestCase):
+    def _run(self, *args, **kw):
+        return subprocess.run(
+            [sys.executable, os.path.join(TOOLS_DIR, 'zuul-changes.py')] +
+            list(args),
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            universal_newlines=True, check=True, **kw).stdout
+
+    def _read(self, path):
+        with open(path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_snapshot(self):
+        api = self.useFixture(FakeZuulAPI(STATUS))
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                            'queues.jsonl')
+        self._run(api.url, '--snapshot', path)
+        items = self._read(path)
+        self.assertEqual([
+            {'tenant': 'tenant-one', 'pipeline': 'gate',
+             'queue': 'integrated', 'position': 0,
+             'project': 'example.com/org/nova',
+             'change': '100', 'patchset': '1'},
+            {'tenant': 'tenant-one', 'pipeline': 'gate',
+             'queue': 'integrated', 'position': 1,
+             'project': 'example.com/org/glance',
+             'change': '102', 'patchset': '3'},
+            {'tenant': 'tenant-one', 'pipeline': 'gate',
+             'queue': 'other', 'position': 2,
+             'project': 'example.com/org/docs',
+             'change': '103', 'patchset': '1'},
+            {'tenant': 'tenant-one', 'pipeline': 'post',
+             'queue': None, 'position': 0,
+             'project': 'example.com/org/nova',
+             'ref': 'refs/heads/master', 'newrev': 'abcdef'},
+            {'tenant': 'tenant-one', 'pipeline': 'post',
+             'queue': None, 'position': 1,
+             'project': 'example.com/org/nova',
+             'ref': 'refs/tags/1.0'},
+            {'tenant': 'tenant-two', 'pipeline': 'check',
+             'queue': None, 'position': 0,
+             'project': 'example.com/org/ansible',
+             'change': '200', 'patchset': '4'},
+            {'tenant': 'tenant-two', 'pipeline': 'check',
+             'queue': None, 'position': 1,
+             'project': 'example.com/org/zuul',
+             'change': '201', 'patchset': '1'},
+        ], items)
+
+    def _write_snapshot(self, root):
+        # Three pipelines of five items each, written out of order
+        items = []
+        for position in (3, 0, 4, 1, 2):
+            for tenant, pipeline in (('t1', 'gate'), ('t1', 'check'),
+                                     ('t2', 'gate')):
+                items.append(dict(
+                    tenant=tenant, pipeline=pipeline, queue=None,
+                    position=position, project='example.com/org/project',
+                    change=str(position), patchset='1'))
+        path = os.path.join(root, 'queues.jsonl')
+        with open(path, 'w') as f:
+            for item in items:
+                f.write(json.dumps(item) + '\n')
+        return path
+
+    def _check_order(self, commands):
+        # Every command enqueues a change, which is its position
+        groups = {}
+        for cmd in commands:
+            args = cmd.split()
+            key = (args[args.index('--tenant') + 1],
+                   args[args.index('--pipeline') + 1])
+            groups.setdefault(key, []).append(
+                args[args.index('--change') + 1])
+        self.assertEqual({
+            ('t1', 'gate'): ['0,1', '1,1', '2,1', '3,1', '4,1'],
+            ('t1', 'check'): ['0,1', '1,1', '2,1', '3,1', '4,1'],
+            ('t2', 'gate'): ['0,1', '1,1', '2,1', '3,1', '4,1'],
+        }, groups)
+
+    def test_restore_dry_run(self):
+        root = self.useFixture(fixtures.TempDir()).path
+        out = self._run('--restore', self._write_snapshot(root),
+                        '--dry-run', '--workers', '4')
+        commands = out.splitlines()
+        self.assertEqual(15, len(commands))
+        self._check_order(commands)
+
+    def test_restore(self):
+        root = self.useFixture(fixtures.TempDir()).path
+        # A zuul-client which logs its arguments after a random delay,
+        # so that the pipelines interleave.
+        bin_dir = os.path.join(root, 'bin')
+        os.mkdir(bin_dir)
+        log = os.path.join(root, 'zuul-client.log')
+        client = os.path.join(bin_dir, 'zuul-client')
+        with open(client, 'w') as f:
+            f.write('#!/bin/sh\n'
+                    'sleep 0.0$(od -An -N1 -tu1 /dev/urandom | tr -d " ")\n'
+                    'echo "zuul-client $*" >> %s\n' % (log,))
+        os.chmod(client, 0o755)
+        env = dict(os.environ,
+                   PATH=bin_dir + os.pathsep + os.environ['PATH'])
+        self._run('--restore', self._write_snapshot(root),
+                  '--workers', '4', env=env)
+        with open(log) as f:
+            commands = f.read().splitlines()
+        self.assertEqual(15, len(commands))
+        self._check_order(commands)
@@ -20,39 +20,63 @@ except ImportError:
     from urllib2 import urlopen
 import json
 import argparse
+import shlex
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
 
 parser = argparse.ArgumentParser()
-parser.add_argument('url', help='The URL of the running Zuul instance')
+parser.add_argument('url', help='The URL of the running Zuul instance',
+                    nargs='?')
 parser.add_argument('tenant', help='The Zuul tenant', nargs='?')
 parser.add_argument('pipeline', help='The name of the Zuul pipeline',
                     nargs='?')
 parser.add_argument('--use-config',
                     metavar='CONFIG',
                     help='The name of the zuul-client config to use')
+parser.add_argument('--snapshot',
+                    metavar='FILE',
+                    help='Save the live queue items to a JSON Lines file '
+                    'instead of printing enqueue commands')
+parser.add_argument('--restore',
+                    metavar='FILE',
+                    help='Re-enqueue the items saved in a snapshot file')
+parser.add_argument('--dry-run', action='store_true',
+                    help='With --restore, print the commands instead of '
+                    'running them')
+parser.add_argument('--workers', type=int, default=8,
+                    help='Number of pipelines restored in parallel')
 options = parser.parse_args()
+if not options.restore and not options.url:
+    parser.error('the url argument is required unless --restore is used')
 
 command = 'zuul-client'
 if options.use_config:
     command += f' --use-config {options.use_config}'
 
-# Check if tenant is white label
-info = json.loads(urlopen('%s/api/info' % options.url).read())
-api_tenant = info.get('info', {}).get('tenant')
-tenants = []
-if api_tenant:
-    if api_tenant == options.tenant:
-        tenants.append(None)
+
+def get_tenants():
+    # Check if tenant is white label
+    info = json.loads(urlopen('%s/api/info' % options.url).read())
+    api_tenant = info.get('info', {}).get('tenant')
+    tenants = []
+    if api_tenant:
+        if api_tenant == options.tenant:
+            tenants.append(None)
+        else:
+            print("Error: %s doesn't match tenant %s (!= %s)" % (
+                options.url, options.tenant, api_tenant))
+            exit(1)
     else:
-        print("Error: %s doesn't match tenant %s (!= %s)" % (
-            options.url, options.tenant, api_tenant))
-        exit(1)
-else:
-    tenants_url = '%s/api/tenants' % options.url
-    data = json.loads(urlopen(tenants_url).read())
-    for tenant in data:
-        tenants.append(tenant['name'])
+        tenants_url = '%s/api/tenants' % options.url
+        data = json.loads(urlopen(tenants_url).read())
+        for tenant in data:
+            tenants.append(tenant['name'])
+    return tenants
 
-for tenant in tenants:
+
+def get_items(tenant):
+    # Yield one record per live queue item, in queue order
     if tenant is None:
         status_url = '%s/api/status' % options.url
     else:
@@ -63,33 +87,127 @@ for tenant in tenants:
     for pipeline in data['pipelines']:
         if options.pipeline and pipeline['name'] != options.pipeline:
             continue
+        position = 0
         for queue in pipeline.get('change_queues', []):
             for head in queue['heads']:
                 for change in head:
                     if not change['live']:
                         continue
 
+                    item = {
+                        'tenant': tenant,
+                        'pipeline': pipeline['name'],
+                        'queue': queue.get('name'),
+                        'position': position,
+                        'project': change['project_canonical'],
+                    }
+                    position += 1
                     if change['id'] and ',' in change['id']:
                         # change triggered
                         cid, cps = change['id'].split(',')
-                        print("%s enqueue"
-                              " --tenant %s"
-                              " --pipeline %s"
-                              " --project %s"
-                              " --change %s,%s" % (command, tenant,
-                                                   pipeline['name'],
-                                                   change['project_canonical'],
-                                                   cid, cps))
+                        item['change'] = cid
+                        item['patchset'] = cps
                     else:
                         # ref triggered
-                        cmd = '%s enqueue-ref' \
-                              ' --tenant %s' \
-                              ' --pipeline %s' \
-                              ' --project %s' \
-                              ' --ref %s' % (command, tenant,
-                                             pipeline['name'],
-                                             change['project_canonical'],
-                                             change['ref'])
+                        item['ref'] = change['ref']
                         if change['id']:
-                            cmd += ' --newrev %s' % change['id']
-                        print(cmd)
+                            item['newrev'] = change['id']
+                    yield item
+
+
+def get_command(item):
+    if 'change' in item:
+        return ("%s enqueue"
+                " --tenant %s"
+                " --pipeline %s"
+                " --project %s"
+                " --change %s,%s" % (command, item['tenant'],
+                                     item['pipeline'],
+                                     item['project'],
+                                     item['change'], item['patchset']))
+    cmd = '%s enqueue-ref' \
+          ' --tenant %s' \
+          ' --pipeline %s' \
+          ' --project %s' \
+          ' --ref %s' % (command, item['tenant'],
+                         item['pipeline'],
+                         item['project'],
+                         item['ref'])
+    if item.get('newrev'):
+        cmd += ' --newrev %s' % item['newrev']
+    return cmd
+
+
+def snapshot(path):
+    count = 0
+    with open(path, 'w') as f:
+        for tenant in get_tenants():
+            for item in get_items(tenant):
+                if item['tenant'] is None:
+                    item['tenant'] = options.tenant
+                f.write(json.dumps(item, separators=(',', ':')))
+                f.write('\n')
+                count += 1
+    print("Saved %d items to %s" % (count, path))
+
+
+def restore_pipeline(items):
+    # Items of a single pipeline are enqueued one at a time so that
+    # they end up in the same order as when the snapshot was taken.
+    failed = []
+    for item in items:
+        cmd = get_command(item)
+        if options.dry_run:
+            print(cmd)
+            continue
+        try:
+            result = subprocess.run(shlex.split(cmd),
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT)
+        except OSError as e:
+            failed.append((cmd, str(e)))
+            continue
+        if result.returncode:
+            failed.append((cmd, result.stdout.decode('utf8').strip()))
+    return failed
+
+
+def restore(path):
+    pipelines = {}
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            if options.tenant and item['tenant'] != options.tenant:
+                continue
+            if options.pipeline and item['pipeline'] != options.pipeline:
+                continue
+            key = (item['tenant'], item['pipeline'])
+            pipelines.setdefault(key, []).append(item)
+
+    workers = 1 if options.dry_run else max(1, options.workers)
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for items in pipelines.values():
+            items.sort(key=lambda i: i['position'])
+            futures.append(executor.submit(restore_pipeline, items))
+        for f in futures:
+            failed.extend(f.result())
+
+    for cmd, out in failed:
+        print("Failed: %s" % cmd)
+        print("  %s" % out)
+    if failed:
+        sys.exit(1)
+
+
+if options.restore:
+    restore(options.restore)
+elif options.snapshot:
+    snapshot(options.snapshot)
+else:
+    for tenant in get_tenants():
+        for item in get_items(tenant):
+            print(get_command(item))
@@ -14,12 +14,15 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import argparse
 import ctypes
 import errno
 import fcntl
 import os
+import shutil
 import struct
 import subprocess
+import time
 
 """Add entropy to the kernel until the nonblocking pool is
 initialized.
@@ -175,8 +178,18 @@ class Pump(object):
     # internal kernel buffer, so we match it.
     CHUNK_SIZE = 64
 
-    # The syscall number for getrandom(2).
-    SYS_getrandom = 318
+    # The syscall number for getrandom(2), by machine.
+    SYS_getrandom = {
+        'x86_64': 318,
+        'i386': 355,
+        'i686': 355,
+        'aarch64': 278,
+        'riscv64': 278,
+        'armv7l': 384,
+        'ppc64': 359,
+        'ppc64le': 359,
+        's390x': 349,
+    }
 
     # The IOCTL to add entropy.
     OP_RNDADDENTROPY = 0x40085203
@@ -185,27 +198,35 @@ class Pump(object):
     GRND_NONBLOCK = 0x0001  # Do not block
     GRND_RANDOM = 0x0002  # Use /dev/random instead of urandom
 
+    # Supply unlimited data on stdout, and print summary information.
+    HAVEGED = ['/usr/sbin/haveged', '-f', '-', '-n', '0', '-v', '1']
+
     def __init__(self):
-        # Use ctypes to invoke getrandom since it is not available in
-        # python.  os.urandom may call getrandom in some versions of
-        # python3, however, the blocking on initialization behavior is
-        # seen as a bug and so os.urandom will never block, even if
-        # getrandom would. See http://bugs.python.org/issue26839
+        # Use ctypes to invoke getrandom if it is not available in
+        # python (it is as os.getrandom since python 3.6).  os.urandom
+        # may call getrandom in some versions of python3, however, the
+        # blocking on initialization behavior is seen as a bug and so
+        # os.urandom will never block, even if getrandom would. See
+        # http://bugs.python.org/issue26839
         self._getrandom = ctypes.CDLL(None, use_errno=True).syscall
         self._getrandom.restype = ctypes.c_long
         # The arguments are syscall number, void *buf,
         # size_t buflen, unsigned int flags.
         self._getrandom.argtypes = (ctypes.c_long, ctypes.c_void_p,
                                     ctypes.c_size_t, ctypes.c_uint)
+        self.sys_getrandom = self.SYS_getrandom.get(os.uname().machine)
 
     def getrandom(self, length, random=False, nonblock=False):
+        if self.sys_getrandom is None:
+            raise Exception("getrandom: Unknown syscall number for %s" %
+                            os.uname().machine)
         flags = 0
         if random:
             flags |= self.GRND_RANDOM
         if nonblock:
             flags |= self.GRND_NONBLOCK
         buf = ctypes.ARRAY(ctypes.c_char, length)()
-        r = self._getrandom(self.SYS_getrandom, buf, len(buf), flags)
+        r = self._getrandom(self.sys_getrandom, buf, len(buf), flags)
         if r == -1:
             err = ctypes.get_errno()
             if err == errno.EINVAL:
@@ -223,51 +244,115 @@ class Pump(object):
         # Read one byte from getrandom to determine whether the
         # nonblocking pool is initialized.
         try:
-            r = self.getrandom(1, nonblock=True)
-            if len(r) != 1:
-                raise Exception("No data returned from getrandom")
-            print("Nonblocking pool initialized")
-            return True
-        except GeneratorNotInitializedError:
+            if hasattr(os, 'getrandom'):
+                r = os.getrandom(1, os.GRND_NONBLOCK)
+            else:
+                r = self.getrandom(1, nonblock=True)
+        except (BlockingIOError, GeneratorNotInitializedError):
             return False
+        if len(r) != 1:
+            raise Exception("No data returned from getrandom")
+        return True
+
+    def openTarget(self):
+        return os.open('/dev/random', os.O_RDWR)
+
+    def addEntropy(self, fd, buf):
+        fcntl.ioctl(fd, self.OP_RNDADDENTROPY, buf)
 
     def run(self):
         """Move data from haveged to the kernel until the nonblocking pool is
         initialized.
 
+        Returns the number of bytes moved.
         """
         if self.isInitialized():
-            return
+            print("Nonblocking pool initialized")
+            return 0
 
-        random_fd = os.open('/dev/random', os.O_RDWR)
-        # Start haveged and tell it to supply unlimited data on
-        # stdout, and print summary information.
-        p = subprocess.Popen(['/usr/sbin/haveged', '-f', '-', '-n', '0',
-                              '-v', '1'],
+        start = time.monotonic()
+        random_fd = self.openTarget()
+        p = subprocess.Popen(self.HAVEGED,
                              stdin=subprocess.PIPE,
                              stdout=subprocess.PIPE,
                              stderr=subprocess.PIPE)
+        # The data structure is:
+        # struct rand_pool_info {
+        #        int     entropy_count;
+        #        int     buf_size;
+        #        __u32   buf[0];
+        # };
+        # The header is the same for every chunk, so it is written
+        # once and the data from haveged is read in place after it.
+        header = struct.calcsize('ii')
+        buf = bytearray(header + self.CHUNK_SIZE)
+        struct.pack_into('ii', buf, 0, self.CHUNK_SIZE * 8, self.CHUNK_SIZE)
+        data = memoryview(buf)[header:]
+        moved = 0
         while not self.isInitialized():
             # Read a chunk from haveged.
-            data = b''
-            while len(data) < self.CHUNK_SIZE:
-                data += p.stdout.read(self.CHUNK_SIZE - len(data))
-            # The data structure is:
-            # struct rand_pool_info {
-            #        int     entropy_count;
-            #        int     buf_size;
-            #        __u32   buf[0];
-            # };
-            arg = struct.pack('iis', len(data) * 8, len(data), data)
-            print("Moving %s bytes" % len(data))
-            fcntl.ioctl(random_fd, self.OP_RNDADDENTROPY, arg)
+            pos = 0
+            while pos < self.CHUNK_SIZE:
+                n = p.stdout.readinto(data[pos:])
+                if not n:
+                    raise Exception("haveged exited: %s" %
+                                    p.stderr.read().decode('utf-8'))
+                pos += n
+            self.addEntropy(random_fd, buf)
+            moved += self.CHUNK_SIZE
         # Now that the generator is initialized, stop haveged and
         # print the summary information.
         p.send_signal(2)
         p.stdout.read()
+        print("Nonblocking pool initialized after moving %s bytes in %.3fs" %
+              (moved, time.monotonic() - start))
         print(p.stderr.read().decode('utf-8'))
+        return moved
+
+
+class BenchmarkPump(Pump):
+    """Pump into a fake /dev/random, which counts as initialized once
+    enough entropy has been added to it.  The getrandom(2) probes are
+    still made, so their cost is included.
+
+    """
+    def __init__(self, bits, command):
+        super(BenchmarkPump, self).__init__()
+        self.bits = bits
+        self.added = 0
+        if command:
+            self.HAVEGED = command
+
+    def isInitialized(self):
+        super(BenchmarkPump, self).isInitialized()
+        return self.added >= self.bits
+
+    def openTarget(self):
+        return None
+
+    def addEntropy(self, fd, buf):
+        self.added += struct.unpack_from('i', buf)[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Initialize the nonblocking kernel random number "
+        "generator")
+    parser.add_argument('--benchmark', type=int, metavar='BITS',
+                        help="Measure the time to add BITS of entropy to "
+                        "a fake /dev/random instead")
+    args = parser.parse_args()
+
+    if args.benchmark is None:
+        Pump().run()
+        return
+    command = None
+    if not os.path.exists(Pump.HAVEGED[0]):
+        command = [shutil.which('cat'), '/dev/urandom']
+        print("haveged not found, using %s" % ' '.join(command))
+    pump = BenchmarkPump(args.benchmark, command)
+    pump.run()
 
 
 if __name__ == '__main__':
-    p = Pump()
-    p.run()
+    main()
@@ -13,6 +13,10 @@
 # under the License.
 
 import argparse
+import concurrent.futures
+import contextlib
+import functools
+import gzip
 import json
 import logging
 import mimetypes
@@ -37,61 +41,339 @@ def path_in_tree(root, path):
     return True
 
 
-def _get_file_info(path):
+def _get_file_info(path, entry=None):
     try:
-        st = os.stat(path)
+        if entry is not None:
+            # The DirEntry caches the result
+            st = entry.stat()
+        else:
+            st = os.stat(path)
     except OSError:
         return 0, 0
 
     return st[stat.ST_MTIME], st[stat.ST_SIZE]
 
 
-def walk(root, original_root=None):
-    if original_root is None:
-        original_root = root
+@functools.lru_cache(maxsize=4096)
+def _guess_type(ext):
+    # The guess only depends on the last two extensions of the name,
+    # and log trees repeat the same few of them over and over.
+    mime_guess, encoding = mimetypes.guess_type('file' + ext)
+    if not mime_guess:
+        mime_guess = 'text/plain'
+    return mime_guess, encoding
+
+
+def guess_type(name):
+    base, ext = os.path.splitext(name)
+    return _guess_type(os.path.splitext(base)[1] + ext)
+
+
+class _CountingWriter:
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+def _get_compressed_size(path):
+    # The size of the file once gzipped the same way the log upload
+    # does it (maximum compression, name in the header).
+    out = _CountingWriter()
+    try:
+        with open(path, 'rb') as f:
+            with gzip.GzipFile(path + '.gz', 'wb', fileobj=out) as gz:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    gz.write(chunk)
+    except OSError:
+        return None
+    return out.size
+
+
+def _refresh(path, entry, compressed=frozenset()):
+    # Update a file entry from a previous run if the file was changed
+    # in place.  Returns None if the file is gone.
+    last_modified, size = _get_file_info(path)
+    if not last_modified and not size:
+        return None
+    if (entry['last_modified'], entry['size']) == (last_modified, size):
+        return entry
+    entry = dict(entry, last_modified=last_modified, size=size)
+    entry.pop('compressed_size', None)
+    if path in compressed:
+        compressed_size = _get_compressed_size(path)
+        if compressed_size is not None:
+            entry['compressed_size'] = compressed_size
+    return entry
+
+
+def _scan(root, real_root, original_root, compressed=frozenset(),
+          exclude=frozenset()):
+    # List a single directory.  Returns the subdirectories to walk as
+    # (name, path, real path) tuples and the file entries.  real_root
+    # is the resolved path of root, so only symlinks need resolving
+    # to check whether an entry is in the tree.  Files whose paths are
+    # in compressed get their gzipped size added, files whose real
+    # paths are in exclude are left out.
     logging.debug("Walk: %s", root)
-    data = []
     dirs = []
     files = []
-    for e in os.listdir(root):
-        if os.path.isdir(os.path.join(root, e)):
-            if not os.path.islink(os.path.join(root, e)):
-                dirs.append(e)
-        else:
-            files.append(e)
-    for d in sorted(dirs):
-        logging.debug("Directory: %s", d)
-        path = os.path.join(root, d)
-        if not path_in_tree(original_root, path):
+    with os.scandir(root) as it:
+        for e in it:
+            if e.is_dir():
+                if not e.is_symlink():
+                    dirs.append(e)
+            else:
+                files.append(e)
+    subdirs = []
+    for e in sorted(dirs, key=lambda e: e.name):
+        logging.debug("Directory: %s", e.name)
+        real_path = os.path.join(real_root, e.name)
+        if not real_path.startswith(original_root):
+            logging.debug("Skipping path outside root: %s" % (e.path,))
             continue
-        data.append(dict(name=d,
-                         mimetype='application/directory',
-                         encoding=None,
-                         children=walk(os.path.join(root, d), original_root)))
-    for f in sorted(files):
-        logging.debug("File: %s", f)
-        path = os.path.join(root, f)
-        if not path_in_tree(original_root, path):
-            continue
-        mime_guess, encoding = mimetypes.guess_type(path)
-        if not mime_guess:
-            mime_guess = 'text/plain'
-        last_modified, size = _get_file_info(path)
+        subdirs.append((e.name, e.path, real_path))
+    data = []
+    for e in sorted(files, key=lambda e: e.name):
+        logging.debug("File: %s", e.name)
+        if e.is_symlink():
+            if not path_in_tree(original_root, e.path):
+                continue
+        else:
+            real_path = os.path.join(real_root, e.name)
+            if not real_path.startswith(original_root):
+                logging.debug("Skipping path outside root: %s" % (e.path,))
+                continue
+            if real_path in exclude:
+                continue
+        mime_guess, encoding = guess_type(e.name)
+        last_modified, size = _get_file_info(e.path, e)
         if not last_modified and not size:
             continue
-        data.append(dict(name=f,
-                         mimetype=mime_guess,
-                         encoding=encoding,
-                         last_modified=last_modified,
-                         size=size))
-    return data
+        entry = dict(name=e.name,
+                     mimetype=mime_guess,
+                     encoding=encoding,
+                     last_modified=last_modified,
+                     size=size)
+        if e.path in compressed:
+            compressed_size = _get_compressed_size(e.path)
+            if compressed_size is not None:
+                entry['compressed_size'] = compressed_size
+        data.append(entry)
+    return subdirs, data
+
+
+def _directory(name, children):
+    return dict(name=name,
+                mimetype='application/directory',
+                encoding=None,
+                children=children)
+
+
+class ManifestIndex:
+    # The directory listings of a previous run, keyed by their path
+    # relative to the root along with the mtime of the directory.  A
+    # directory whose mtime hasn't changed since has had no entries
+    # added, removed or renamed, so its listing is reused instead of
+    # walking it again; only its files are stat'ed again to pick up
+    # changes made in place.
+    #
+    # Used as a context manager, the new index is written as the
+    # directories are added, and replaces the previous one on success.
+    VERSION = 1
+
+    def __init__(self, path, root, compressed):
+        self.path = path
+        self.key = dict(version=self.VERSION, root=root,
+                        compressed=sorted(compressed))
+        self.old = self._load()
+        self.count = 0
+        self.reused = 0
+        self._f = None
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if data.get('key') != self.key:
+            return {}
+        return data['dirs']
+
+    def __enter__(self):
+        self._f = open(self.path + '.tmp', 'w')
+        self._f.write('{"key": %s, "dirs": {' % (json.dumps(self.key),))
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        tmp = self._f.name
+        if exc_type is None:
+            self._f.write('}}')
+        self._f.close()
+        if exc_type is None:
+            os.replace(tmp, self.path)
+        else:
+            os.unlink(tmp)
+
+    def scan(self, scan_dir, refresh, path, real_path):
+        # Called from the executor threads, so this only reads the old
+        # index.  Returns the listing and the entry to pass to add().
+        rel = os.path.relpath(path, self.key['root'])
+        # Check the mtime before listing, so that a change made during
+        # the listing is picked up by the next run.
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            mtime = None
+        old = self.old.get(rel)
+        reused = (old is not None and mtime is not None and
+                  old['mtime'] == mtime)
+        if reused:
+            subdirs = [(name, os.path.join(path, name),
+                        os.path.join(real_path, name))
+                       for name in old['subdirs']]
+            files = []
+            for entry in old['files']:
+                entry = refresh(os.path.join(path, entry['name']), entry)
+                if entry is not None:
+                    files.append(entry)
+        else:
+            subdirs, files = scan_dir(path, real_path)
+        data = dict(mtime=mtime,
+                    subdirs=[name for name, _, _ in subdirs],
+                    files=files)
+        return subdirs, files, (rel, data, reused)
+
+    def add(self, rel, data, reused):
+        # Called from the walking thread only
+        if self.count:
+            self._f.write(', ')
+        self._f.write('%s: %s' % (json.dumps(rel), json.dumps(data)))
+        self.count += 1
+        if reused:
+            self.reused += 1
+
+
+def _scanner(original_root, compressed=(), executor=None, index=None,
+             exclude=()):
+    # Returns a function listing one directory.  With an executor, the
+    # subdirectories of every listed directory are listed ahead in the
+    # background.  Only the siblings along the current path are queued
+    # so memory stays bounded by the depth of the tree.
+    compressed = frozenset(os.path.join(original_root, path)
+                           for path in compressed)
+    exclude = frozenset(_realpath(path) for path in exclude)
+
+    def list_dir(path, real_path):
+        return _scan(path, real_path, original_root, compressed, exclude)
+
+    def refresh(path, entry):
+        return _refresh(path, entry, compressed)
+
+    def scan_dir(path, real_path):
+        if index is not None:
+            return index.scan(list_dir, refresh, path, real_path)
+        return list_dir(path, real_path) + (None,)
+
+    def record(subdirs, files, entry):
+        # The index is only updated from the walking thread, in the
+        # order of the walk.
+        if entry is not None:
+            index.add(*entry)
+        return subdirs, files
+
+    if executor is None:
+        return lambda path, real_path: record(*scan_dir(path, real_path))
+    futures = {}
+
+    def scan(path, real_path):
+        future = futures.pop(path, None)
+        if future is None:
+            future = executor.submit(scan_dir, path, real_path)
+        subdirs, files = record(*future.result())
+        for name, sub_path, sub_real_path in subdirs:
+            futures[sub_path] = executor.submit(
+                scan_dir, sub_path, sub_real_path)
+        return subdirs, files
+
+    return scan
+
+
+def _executor(workers):
+    if workers > 1:
+        return concurrent.futures.ThreadPoolExecutor(workers)
+    return contextlib.nullcontext()
+
+
+def _index(path, root, compressed):
+    if path:
+        return ManifestIndex(path, root, compressed)
+    return contextlib.nullcontext()
+
+
+def _realpath(path):
+    return os.path.realpath(os.path.abspath(os.path.expanduser(path)))
+
+
+def _walk(scan, root, real_root):
+    subdirs, files = scan(root, real_root)
+    return [_directory(name, _walk(scan, path, real_path))
+            for name, path, real_path in subdirs] + files
+
+
+def walk(root, original_root=None, workers=1, compressed=()):
+    if original_root is None:
+        original_root = root
+    with _executor(workers) as executor:
+        return _walk(_scanner(original_root, compressed, executor), root,
+                     _realpath(root))
+
+
+def _write_tree(f, scan, root, real_root):
+    # Write the same JSON as json.dumps(walk(root)), one entry at a
+    # time, so that the whole tree is never held in memory.
+    subdirs, files = scan(root, real_root)
+    f.write('[')
+    sep = ''
+    for name, path, real_path in subdirs:
+        f.write('%s{"name": %s, "mimetype": "application/directory", '
+                '"encoding": null, "children": ' % (sep, json.dumps(name)))
+        _write_tree(f, scan, path, real_path)
+        f.write('}')
+        sep = ', '
+    for data in files:
+        f.write(sep)
+        f.write(json.dumps(data))
+        sep = ', '
+    f.write(']')
 
 
-def run(root_path, output, index_links):
-    data = walk(root_path, root_path)
-    with open(output, 'w') as f:
-        f.write(json.dumps({'tree': data,
-                            'index_links': index_links}))
+def run(root_path, output, index_links, workers=1, compressed=(),
+        index_path=None):
+    # With index_path, only the directories changed since the previous
+    # run with the same index are walked.
+    tmp = output + '.tmp'
+    # The output is usually written inside the root; leave it out of
+    # the manifest, whether or not it is already there.
+    exclude = [output, tmp]
+    with open(tmp, 'w') as f, \
+            _index(index_path, root_path, compressed) as index, \
+            _executor(workers) as executor:
+        f.write('{"tree": ')
+        _write_tree(f, _scanner(root_path, compressed, executor, index,
+                                exclude),
+                    root_path, _realpath(root_path))
+        f.write(', "index_links": %s}' % (json.dumps(index_links),))
+    os.replace(tmp, output)
+    if index is not None:
+        logging.debug("Reused %d of %d directories from %s",
+                      index.reused, index.count, index_path)
 
 
 def ansible_main():
@@ -100,11 +382,15 @@ def ansible_main():
             root=dict(type='path'),
             output=dict(type='path'),
             index_links=dict(type='bool', default=False),
+            workers=dict(type='int', default=1),
+            compressed=dict(type='list', elements='str', default=[]),
+            index=dict(type='path'),
         )
     )
 
     p = module.params
-    run(p.get('root'), p.get('output'), p.get('index_links'))
+    run(p.get('root'), p.get('output'), p.get('index_links'),
+        p.get('workers'), p.get('compressed'), p.get('index'))
 
     module.exit_json(changed=True)
 
@@ -121,13 +407,22 @@ def cli_main():
                         help='Output file path')
     parser.add_argument('index_links', action='store_true',
                         help='Link to index.html instead of dirs')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of directories to list concurrently')
+    parser.add_argument('--compressed', action='append', default=[],
+                        help='Add the gzipped size of this file, relative '
+                        'to the root (may be repeated)')
+    parser.add_argument('--index',
+                        help='Only walk the directories changed since the '
+                        'previous run with this index file')
 
     args = parser.parse_args()
 
     if args.verbose:
         logging.basicConfig(level=logging.DEBUG)
 
-    run(args.root, args.output, args.index_links)
+    run(args.root, args.output, args.index_links, args.workers,
+        args.compressed, args.index)
 
 
 if __name__ == '__main__':
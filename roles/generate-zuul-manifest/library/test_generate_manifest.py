@@ -18,13 +18,19 @@
 from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
+import gzip
+import io
+import json
+import logging
 import os
+import shutil
 import stat
 import testtools
 import fixtures
 
 from .generate_manifest import _get_file_info
-from .generate_manifest import walk
+from .generate_manifest import run, walk
+from . import generate_manifest
 
 
 FIXTURE_DIR = os.path.join(os.path.dirname(__file__),
@@ -122,6 +128,102 @@ class TestFileList(testtools.TestCase):
             ('symlink_loop/placeholder', 'text/plain', None),
         ])
 
+    def test_parallel_walk(self):
+        '''Test that a parallel walk returns the same tree'''
+        self.useFixture(SymlinkFixture())
+        for name in ('logs', 'links'):
+            root = os.path.join(FIXTURE_DIR, name)
+            self.assertEqual(walk(root), walk(root, workers=4))
+
+    def test_run(self):
+        '''Test that the streamed manifest matches the walk'''
+        self.useFixture(SymlinkFixture())
+        output = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                              'zuul-manifest.json')
+        for name in ('logs', 'links'):
+            root = os.path.join(FIXTURE_DIR, name)
+            for workers in (1, 4):
+                run(root, output, True, workers)
+                with open(output) as f:
+                    self.assertEqual(
+                        json.dumps({'tree': walk(root),
+                                    'index_links': True}),
+                        f.read())
+
+    def test_run_output_in_root(self):
+        '''Test that an output inside the root is not listed'''
+        tmp = self.useFixture(fixtures.TempDir()).path
+        root = os.path.join(tmp, 'logs')
+        shutil.copytree(os.path.join(FIXTURE_DIR, 'logs'), root)
+        expected = json.dumps({'tree': walk(root), 'index_links': False})
+        output = os.path.join(root, 'zuul-manifest.json')
+        # Once when the output is created and once when it is replaced
+        for i in range(2):
+            run(root, output, False, workers=2)
+            with open(output) as f:
+                self.assertEqual(expected, f.read())
+            self.assertFalse(os.path.exists(output + '.tmp'))
+
+    def test_compressed_size(self):
+        '''Test the gzipped size of selected files'''
+        root = os.path.join(FIXTURE_DIR, 'logs')
+        fl = self.flatten(walk(root, compressed=['job-output.json']))
+        path = os.path.join(root, 'job-output.json')
+        out = io.BytesIO()
+        with open(path, 'rb') as f:
+            with gzip.GzipFile(path + '.gz', 'wb', fileobj=out) as gz:
+                gz.write(f.read())
+        for x in fl:
+            if x['_relative_path'] == 'job-output.json':
+                self.assertEqual(len(out.getvalue()), x['compressed_size'])
+            else:
+                self.assertNotIn('compressed_size', x)
+
+    def test_run_incremental(self):
+        '''Test that only changed directories are walked again'''
+        tmp = self.useFixture(fixtures.TempDir()).path
+        root = os.path.join(tmp, 'logs')
+        shutil.copytree(os.path.join(FIXTURE_DIR, 'logs'), root)
+        output = os.path.join(tmp, 'zuul-manifest.json')
+        index = os.path.join(tmp, 'zuul-manifest.index')
+
+        scanned = []
+        orig_scan = generate_manifest._scan
+
+        def scan(path, *args):
+            scanned.append(os.path.relpath(path, root))
+            return orig_scan(path, *args)
+
+        self.patch(generate_manifest, '_scan', scan)
+
+        log = self.useFixture(fixtures.FakeLogger(level=logging.DEBUG))
+        compressed = ['job-output.json']
+
+        def check(expected, workers=1):
+            del scanned[:]
+            log.reset_output()
+            run(root, output, False, workers, compressed, index_path=index)
+            self.assertEqual(expected, sorted(scanned))
+            with open(output) as f:
+                self.assertEqual(
+                    json.dumps({'tree': walk(root, compressed=compressed),
+                                'index_links': False}),
+                    f.read())
+            self.assertIn('Reused %d of 4 directories' % (4 - len(expected)),
+                          log.output)
+            self.assertFalse(os.path.exists(index + '.tmp'))
+
+        check(['.', 'controller', 'controller/subdir', 'zuul-info'])
+        check([], workers=4)
+        with open(os.path.join(root, 'controller', 'new.txt'), 'w') as f:
+            f.write('new')
+        check(['controller'], workers=4)
+        # Files changed in place don't change the directory mtime
+        for name in ('job-output.json', 'controller/subdir/subdir.txt'):
+            with open(os.path.join(root, name), 'a') as f:
+                f.write('more content\n')
+        check([])
+
     def test_get_file_info(self):
         '''Test files info'''
         path = os.path.join(FIXTURE_DIR, 'logs', 'job-output.json')
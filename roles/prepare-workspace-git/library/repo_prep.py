@@ -21,20 +21,71 @@ try:
     # Ansible context
     from ansible.module_utils.zuul_jobs.workspace_utils import (
         run,
+        check_concurrency,
         for_each_project,
+        phase,
+        read_git_config,
+        set_git_config,
+        write_git_config,
     )
 except ImportError:
     # Test context
     from ..module_utils.zuul_jobs.workspace_utils import (
         run,
+        check_concurrency,
         for_each_project,
+        phase,
+        read_git_config,
+        set_git_config,
+        write_git_config,
     )
 
 
+# The settings applied to every prepared repo: (section, subsection,
+# key, value).
+WORKSPACE_CONFIG = [
+    ('core', None, 'bare', 'false'),
+    # Allow pushing to non-bare repo
+    ('receive', None, 'denyCurrentBranch', 'ignore'),
+    # Allow deleting current branch
+    ('receive', None, 'denyDeleteCurrent', 'ignore'),
+]
+WORKSPACE_REMOTE = [
+    ('url', 'file:///dev/null'),
+    ('fetch', '+refs/heads/*:refs/remotes/origin/*'),
+]
+# Used to serve partial clones from the cache repos, which are not
+# configured to allow filtering themselves.
+PARTIAL_UPLOAD_PACK = ('git -c uploadpack.allowFilter=true '
+                       '-c uploadpack.allowAnySHA1InWant=true upload-pack')
+
+
+def configure_repo(dest, extra_config=()):
+    # Write the workspace settings into .git/config directly.  This is
+    # equivalent to configure_repo_with_git for a repo we have just
+    # created, but saves spawning five git processes per project.
+    sections = read_git_config(dest)
+    sections = [s for s in sections if s[0] != ('remote', 'origin')]
+    for section, subsection, key, value in (
+            WORKSPACE_CONFIG + list(extra_config)):
+        set_git_config(sections, section, subsection, key, value)
+    for key, value in WORKSPACE_REMOTE:
+        set_git_config(sections, 'remote', 'origin', key, value)
+    write_git_config(dest, sections)
+
+
+def configure_repo_with_git(dest):
+    for section, subsection, key, value in WORKSPACE_CONFIG:
+        run("git config --local %s.%s %s" % (section, key, value), cwd=dest)
+    run("git remote rm origin", cwd=dest, check=False)
+    run("git remote add origin %s" % (WORKSPACE_REMOTE[0][1],), cwd=dest)
+
+
 def prep_one_project(args, project, output):
     start = time.monotonic()
     dest = "%s/%s" % (args['zuul_workspace_root'], project['src_dir'])
     output['dest'] = dest
+    extra_config = []
     if not os.path.isdir(dest):
         cache = "%s/%s" % (args['cached_repos_root'],
                            project['canonical_name'])
@@ -42,22 +93,46 @@ def prep_one_project(args, project, output):
             # We do a bare clone here first so that we skip creating a working
             # copy that will be overwritten later anyway.
             output['initial_state'] = 'cloned-from-cache'
-            out = run("git clone --bare %s %s/.git" % (cache, dest))
+            if project.get('partial_clone'):
+                # Only copy commits and trees.  Blobs are fetched from
+                # the cache when they are checked out, so files outside
+                # of a sparse checkout are never copied.  The cache
+                # stays configured as the remote to fetch them from.
+                output['cache_mode'] = 'partial'
+                clone_opts = ('--bare --filter=blob:none --origin cache '
+                              '--upload-pack "%s"' % (PARTIAL_UPLOAD_PACK,))
+                cache = 'file://' + cache
+                extra_config.append(
+                    ('remote', 'cache', 'uploadpack', PARTIAL_UPLOAD_PACK))
+            elif args.get('cache_mode') == 'shared':
+                # Borrow the objects of the cache through
+                # objects/info/alternates instead of copying or
+                # hardlinking them; only the refs are copied.  The
+                # sync push then only sends objects the cache lacks.
+                output['cache_mode'] = 'shared'
+                clone_opts = '--bare --shared'
+            else:
+                output['cache_mode'] = 'clone'
+                clone_opts = '--bare'
+            with phase(output, 'clone'):
+                out = run("git clone %s %s %s/.git" % (
+                    clone_opts, cache, dest))
             output['clone'] = out.stdout.decode('utf8').strip()
         else:
             output['initial_state'] = 'git-init'
-            out = run("git init %s" % (dest,))
+            with phase(output, 'init'):
+                out = run("git init %s" % (dest,))
             output['init'] = out.stdout.decode('utf8').strip()
     else:
         output['initial_state'] = 'pre-existing'
 
-    run("git config --local --bool core.bare false", cwd=dest)
-    # Allow pushing to non-bare repo
-    run("git config --local receive.denyCurrentBranch ignore", cwd=dest)
-    # Allow deleting current branch
-    run("git config --local receive.denyDeleteCurrent ignore", cwd=dest)
-    run("git remote rm origin", cwd=dest, check=False)
-    run("git remote add origin file:///dev/null", cwd=dest)
+    with phase(output, 'config'):
+        if output['initial_state'] == 'pre-existing':
+            # We don't know what else is configured in this repo (e.g.
+            # branches tracking origin), so let git update it.
+            configure_repo_with_git(dest)
+        else:
+            configure_repo(dest, extra_config)
     end = time.monotonic()
     output['elapsed'] = end - start
 
@@ -65,18 +140,28 @@ def prep_one_project(args, project, output):
 def ansible_main():
     module = AnsibleModule(
         argument_spec=dict(
+            cache_mode=dict(type='str', default='clone',
+                            choices=['clone', 'shared']),
             cached_repos_root=dict(type='path'),
+            concurrency=dict(type='str'),
             executor_work_root=dict(type='path'),
             zuul_projects=dict(type='dict'),
             zuul_workspace_root=dict(type='path'),
         )
     )
 
+    try:
+        check_concurrency(module.params['concurrency'])
+    except ValueError as e:
+        module.fail_json(str(e))
+
     output = {}
-    if for_each_project(prep_one_project, module.params, output):
-        module.exit_json(changed=True, output=output)
+    timing = {}
+    if for_each_project(prep_one_project, module.params, output, timing):
+        module.exit_json(changed=True, output=output, timing=timing)
     else:
-        module.fail_json("Failure preparing repos", output=output)
+        module.fail_json("Failure preparing repos", output=output,
+                         timing=timing)
 
 
 if __name__ == '__main__':
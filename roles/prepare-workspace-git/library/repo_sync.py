@@ -13,6 +13,12 @@
 # under the License.
 
 import os
+import random
+import re
+import shlex
+import shutil
+import subprocess
+import tempfile
 import time
 
 from ansible.module_utils.basic import AnsibleModule
@@ -21,13 +27,17 @@ try:
     # Ansible context
     from ansible.module_utils.zuul_jobs.workspace_utils import (
         run,
+        check_concurrency,
         for_each_project,
+        phase,
     )
 except ImportError:
     # Test context
     from ..module_utils.zuul_jobs.workspace_utils import (
         run,
+        check_concurrency,
         for_each_project,
+        phase,
     )
 
 
@@ -52,6 +62,121 @@ def get_k8s_dest(args, dest):
     )
 
 
+class SSHMultiplexer(object):
+    # Keep one ControlMaster ssh connection open to the target host so
+    # that the git pushes for all projects share it instead of each
+    # doing its own connection setup and key exchange.
+
+    def __init__(self, args):
+        self.ssh = (os.environ.get('GIT_SSH_COMMAND') or
+                    os.environ.get('GIT_SSH') or 'ssh')
+        self.target = '%s@%s' % (args['ansible_user'],
+                                 args['ansible_host'].strip('[]'))
+        self.port = str(args['ansible_port'] or 22)
+        self.tmpdir = None
+        self.control_path = None
+
+    def _ssh(self, *options):
+        return shlex.split(self.ssh) + [
+            '-o', 'ControlPath=%s' % (self.control_path,),
+            '-p', self.port] + list(options) + [self.target]
+
+    @property
+    def git_ssh_command(self):
+        return '%s -o ControlMaster=no -o ControlPath=%s' % (
+            self.ssh, shlex.quote(self.control_path))
+
+    def start(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='zuul-ssh-')
+        self.control_path = os.path.join(self.tmpdir, 'master')
+        log = os.path.join(self.tmpdir, 'master.log')
+        # The backgrounded master keeps its stdout/stderr open, so they
+        # must not be pipes we wait on; errors go to the log file.
+        result = subprocess.run(
+            self._ssh('-o', 'ControlMaster=yes',
+                      '-o', 'ControlPersist=yes',
+                      '-E', log, '-N', '-f'),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL)
+        if result.returncode:
+            with open(log) as f:
+                error = f.read().strip()
+            self.stop()
+            raise Exception("Unable to start ssh master: %s" % (error,))
+
+    def stop(self):
+        if self.control_path and os.path.exists(self.control_path):
+            subprocess.run(self._ssh('-O', 'exit'),
+                           stdin=subprocess.DEVNULL,
+                           stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL)
+        if self.tmpdir:
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
+        self.tmpdir = self.control_path = None
+
+
+# Above this many changed refs we let git push --mirror work out the
+# update itself rather than passing every refspec on the command line.
+MAX_REFSPECS = 500
+# Base delay in seconds for the jittered exponential retry backoff
+RETRY_DELAY = 1.0
+
+PROGRESS_RE = re.compile(r'^(Enumerating|Counting|Delta compression|'
+                         r'Compressing|Writing) objects|^Total \d+')
+# The "<flag>\t<from>:<to>\t<summary>" lines of push --porcelain,
+# where "=" means the ref was already up to date.
+PORCELAIN_RE = re.compile(r'^([ +\-*!=])\t')
+TOTAL_RE = re.compile(r'^Total (\d+)', re.M)
+WRITTEN_RE = re.compile(
+    r'Writing objects: 100% \(\d+/\d+\), ([\d.]+) (bytes|KiB|MiB|GiB)')
+UNITS = {'bytes': 1, 'KiB': 1024, 'MiB': 1024 ** 2, 'GiB': 1024 ** 3}
+
+
+def get_refs(out):
+    # Parse "<sha> <ref>" lines from for-each-ref or ls-remote
+    refs = {}
+    for line in out.stdout.decode('utf8').splitlines():
+        sha, ref = line.split(None, 1)
+        if ref.startswith('refs/') and not ref.endswith('^{}'):
+            refs[ref] = sha
+    return refs
+
+
+def get_refspecs(local, remote):
+    refspecs = []
+    for ref, sha in sorted(local.items()):
+        if remote.get(ref) != sha:
+            refspecs.append('+%s:%s' % (ref, ref))
+    for ref in sorted(remote):
+        if ref not in local:
+            refspecs.append(':%s' % (ref,))
+    return refspecs
+
+
+def parse_push_output(text, output):
+    # Split the progress messages and ref status lines from the rest of
+    # the push output and record the number of refs updated and the
+    # amount of data sent.
+    lines = []
+    refs = 0
+    for line in re.split(r'[\r\n]+', text):
+        m = PORCELAIN_RE.match(line)
+        if m:
+            if m.group(1) != '=':
+                refs += 1
+        elif line.startswith('To ') or line == 'Done':
+            continue
+        elif line and not PROGRESS_RE.match(line):
+            lines.append(line)
+    output['refs'] = refs
+    m = TOTAL_RE.search(text)
+    output['objects'] = int(m.group(1)) if m else 0
+    m = WRITTEN_RE.search(text)
+    output['bytes'] = int(float(m.group(1)) * UNITS[m.group(2)]) if m else 0
+    return '\n'.join(lines).strip()
+
+
 def sync_one_project(args, project, output):
     cwd = "%s/%s" % (args['executor_work_root'], project['src_dir'])
     dest = "%s/%s" % (args['zuul_workspace_root'], project['src_dir'])
@@ -59,30 +184,79 @@ def sync_one_project(args, project, output):
     output['dest'] = dest
     env = os.environ.copy()
     env['GIT_ALLOW_PROTOCOL'] = 'ext:ssh'
+    if args.get('git_ssh_command'):
+        env['GIT_SSH_COMMAND'] = args['git_ssh_command']
     # We occasionally see git pushes in the middle of this loop fail then
     # subsequent pushes for other repos succeed. The entire loop ends up
     # failing because one of the pushes failed. Mitigate this by retrying
     # on failure.
     max_tries = 3
     start = time.monotonic()
+    # Listing the remote refs first costs a connection of its own, which
+    # is only cheap when it goes over the multiplexed ssh connection.
+    # Otherwise push --mirror negotiates the refs itself.
+    local = None
+    if args.get('git_ssh_command'):
+        with phase(output, 'local-refs'):
+            local = get_refs(run("git for-each-ref --format="
+                                 "'%(objectname) %(refname)'", cwd=cwd))
     for count in range(max_tries):
         try:
             if args['ansible_connection'] == "kubectl":
                 git_dest = get_k8s_dest(args, dest)
             else:
                 git_dest = get_ssh_dest(args, dest)
-            out = run("git push --quiet --mirror %s" % (git_dest,),
-                      cwd=cwd, env=env)
-            output['push'] = out.stdout.decode('utf8').strip()
+            refspecs = None
+            if local is not None:
+                # Only push the refs which differ from what the remote
+                # already has (e.g. from the cache).
+                with phase(output, 'remote-refs'):
+                    remote = get_refs(run("git ls-remote %s" % (git_dest,),
+                                          cwd=cwd, env=env))
+                refspecs = get_refspecs(local, remote)
+                if not refspecs:
+                    output['push'] = ''
+                    output['refs'] = output['objects'] = output['bytes'] = 0
+                    break
+            if refspecs is None or len(refspecs) > MAX_REFSPECS:
+                push_args = '--mirror %s' % (git_dest,)
+            else:
+                push_args = '%s %s' % (git_dest, ' '.join(refspecs))
+            with phase(output, 'push'):
+                out = run("git push --progress --porcelain %s" % (
+                    push_args,), cwd=cwd, env=env)
+            output['push'] = parse_push_output(
+                out.stdout.decode('utf8'), output)
             break
         except Exception:
             if count + 1 >= max_tries:
                 raise
+            time.sleep(random.uniform(0, RETRY_DELAY * 2 ** count))
     end = time.monotonic()
     output['attempts'] = count + 1
     output['elapsed'] = end - start
 
 
+def sync_projects(args, output, timing):
+    if not args.get('ssh_multiplex') or \
+            args['ansible_connection'] == "kubectl":
+        return for_each_project(sync_one_project, args, output, timing)
+
+    mux = SSHMultiplexer(args)
+    try:
+        mux.start()
+    except Exception as e:
+        # Not fatal; every push opens its own connection instead.
+        timing['ssh_multiplex'] = dict(enabled=False, error=str(e))
+        return for_each_project(sync_one_project, args, output, timing)
+    try:
+        timing['ssh_multiplex'] = dict(enabled=True)
+        args = dict(args, git_ssh_command=mux.git_ssh_command)
+        return for_each_project(sync_one_project, args, output, timing)
+    finally:
+        mux.stop()
+
+
 def ansible_main():
     module = AnsibleModule(
         argument_spec=dict(
@@ -90,20 +264,29 @@ def ansible_main():
             ansible_host=dict(type='str'),
             ansible_port=dict(type='int'),
             ansible_user=dict(type='str'),
+            concurrency=dict(type='str'),
             executor_work_root=dict(type='path'),
             inventory_hostname=dict(type='str'),
             mirror_workspace_quiet=dict(type='bool'),
+            ssh_multiplex=dict(type='bool', default=False),
             zuul_projects=dict(type='dict'),
             zuul_resources=dict(type='dict'),
             zuul_workspace_root=dict(type='path'),
         )
     )
 
+    try:
+        check_concurrency(module.params['concurrency'])
+    except ValueError as e:
+        module.fail_json(str(e))
+
     output = {}
-    if for_each_project(sync_one_project, module.params, output):
-        module.exit_json(changed=True, output=output)
+    timing = {}
+    if sync_projects(module.params, output, timing):
+        module.exit_json(changed=True, output=output, timing=timing)
     else:
-        module.fail_json("Failure synchronizing repos", output=output)
+        module.fail_json("Failure synchronizing repos", output=output,
+                         timing=timing)
 
 
 if __name__ == '__main__':
@@ -12,6 +12,7 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import os
 import time
 
 from ansible.module_utils.basic import AnsibleModule
@@ -20,13 +21,25 @@ try:
     # Ansible context
     from ansible.module_utils.zuul_jobs.workspace_utils import (
         run,
+        check_concurrency,
         for_each_project,
+        phase,
+        read_git_config,
+        set_git_config,
+        unset_git_config,
+        write_git_config,
     )
 except ImportError:
     # Test context
     from ..module_utils.zuul_jobs.workspace_utils import (
         run,
+        check_concurrency,
         for_each_project,
+        phase,
+        read_git_config,
+        set_git_config,
+        unset_git_config,
+        write_git_config,
     )
 
 
@@ -35,18 +48,39 @@ def update_one_project(args, project, output):
     output['dest'] = cwd
 
     start = time.monotonic()
-    # Reset is needed because we pushed to a non-bare repo
-    run("git reset --hard", cwd=cwd)
-    # Clean is needed because we pushed to a non-bare repo
-    run("git clean -xdf", cwd=cwd)
-    # Undo the config setting we did in repo_prep
-    run("git config --local --unset receive.denyCurrentBranch", cwd=cwd)
-    run("git config --local --unset receive.denyDeleteCurrent", cwd=cwd)
-    # checkout the branch matching the branch set up by the executor
-    out = run("git checkout --quiet %s" % (project['checkout'],), cwd=cwd)
+    with phase(output, 'config'):
+        # Undo the config setting we did in repo_prep
+        sections = read_git_config(cwd)
+        unset_git_config(sections, 'receive', None, 'denyCurrentBranch')
+        unset_git_config(sections, 'receive', None, 'denyDeleteCurrent')
+        sparse = project.get('sparse_checkout')
+        if sparse:
+            # Only materialize the paths matching these patterns
+            # (gitignore syntax) when checking out below.
+            set_git_config(sections, 'core', None, 'sparseCheckout', 'true')
+            info = os.path.join(cwd, '.git', 'info')
+            os.makedirs(info, exist_ok=True)
+            with open(os.path.join(info, 'sparse-checkout'), 'w') as f:
+                f.write(''.join('%s\n' % (p,) for p in sparse))
+            output['sparse_checkout'] = len(sparse)
+        write_git_config(cwd, sections)
+    # A repo created by repo_prep has no working tree yet, in which case
+    # there is nothing to clean.
+    needs_clean = any(e.name != '.git' for e in os.scandir(cwd))
+    with phase(output, 'checkout'):
+        # Checkout the branch matching the branch set up by the
+        # executor.  Since we pushed to a non-bare repo, the index and
+        # working tree are stale; forcing the checkout replaces them in
+        # one pass instead of a reset followed by a checkout.
+        out = run("git checkout --force --quiet %s" % (
+            project['checkout'],), cwd=cwd)
     output['checkout'] = out.stdout.decode('utf8').strip()
-    # put out a status line with the current HEAD
-    out = run("git log --pretty=oneline -1", cwd=cwd)
+    if needs_clean:
+        with phase(output, 'clean'):
+            run("git clean -xdf", cwd=cwd)
+    with phase(output, 'log'):
+        # put out a status line with the current HEAD
+        out = run("git log --pretty=oneline -1", cwd=cwd)
     end = time.monotonic()
     output['HEAD'] = out.stdout.decode('utf8').strip()
     output['elapsed'] = end - start
@@ -55,16 +89,24 @@ def update_one_project(args, project, output):
 def ansible_main():
     module = AnsibleModule(
         argument_spec=dict(
+            concurrency=dict(type='str'),
             zuul_projects=dict(type='dict'),
             zuul_workspace_root=dict(type='path'),
         )
     )
 
+    try:
+        check_concurrency(module.params['concurrency'])
+    except ValueError as e:
+        module.fail_json(str(e))
+
     output = {}
-    if for_each_project(update_one_project, module.params, output):
-        module.exit_json(changed=True, output=output)
+    timing = {}
+    if for_each_project(update_one_project, module.params, output, timing):
+        module.exit_json(changed=True, output=output, timing=timing)
     else:
-        module.fail_json("Failure updating repos", output=output)
+        module.fail_json("Failure updating repos", output=output,
+                         timing=timing)
 
 
 if __name__ == '__main__':
@@ -15,19 +15,26 @@
 import os
 import pprint
 import shutil
+import time
 
 import testtools
 import fixtures
 
 from ..module_utils.zuul_jobs.workspace_utils import for_each_project, run
+from ..module_utils.zuul_jobs.workspace_utils import phase
+from ..module_utils.zuul_jobs.workspace_utils import AdaptiveLimiter
+from ..module_utils.zuul_jobs.workspace_utils import check_concurrency
 from .repo_prep import prep_one_project
+from .repo_prep import configure_repo, configure_repo_with_git
 from .repo_sync import sync_one_project
 from .repo_update import update_one_project
 from . import repo_sync
 
 
 class TestPrepareWorkspace(testtools.TestCase):
-    def _test_prepare_workspace(self, connection, cached):
+    def _test_prepare_workspace(self, connection, cached,
+                                cache_mode='clone', sync_attempts=1,
+                                ssh_multiplex=False):
         executor_root = self.useFixture(fixtures.TempDir()).path
         project_root = os.path.join(executor_root,
                                     'example.com/org/test-project')
@@ -62,9 +69,11 @@ class TestPrepareWorkspace(testtools.TestCase):
             "ansible_host": "testhost",
             "ansible_port": 22,
             "ansible_user": "zuul",
+            "cache_mode": cache_mode,
             "cached_repos_root": cache_root,
             "executor_work_root": executor_root,
             "inventory_hostname": "testhost",
+            "ssh_multiplex": ssh_multiplex,
             "zuul_workspace_root": work_root,
             "zuul_projects": {
                 "example.com/org/test-project": {
@@ -95,13 +104,28 @@ class TestPrepareWorkspace(testtools.TestCase):
         def my_get_dest(args, dest):
             return dest
 
+        orig_run = repo_sync.run
+
         def my_run(*args, **kw):
             env = kw.get('env', {})
             env.pop('GIT_ALLOW_PROTOCOL', None)
-            return run(*args, **kw)
+            return orig_run(*args, **kw)
 
-        # Override the destination to use a file instead
-        self.patch(repo_sync, 'get_ssh_dest', my_get_dest)
+        if ssh_multiplex:
+            # Go through the ssh stand-in instead
+            ssh_dir = self.useFixture(fixtures.TempDir()).path
+            fake_ssh = os.path.join(ssh_dir, 'ssh')
+            ssh_log = os.path.join(ssh_dir, 'ssh.log')
+            with open(fake_ssh, 'w') as f:
+                f.write(FAKE_SSH)
+            os.chmod(fake_ssh, 0o755)
+            self.useFixture(fixtures.EnvironmentVariable(
+                'GIT_SSH_COMMAND', fake_ssh))
+            self.useFixture(fixtures.EnvironmentVariable(
+                'FAKE_SSH_LOG', ssh_log))
+        else:
+            # Override the destination to use a file instead
+            self.patch(repo_sync, 'get_ssh_dest', my_get_dest)
         self.patch(repo_sync, 'get_k8s_dest', my_get_dest)
         self.patch(repo_sync, 'run', my_run)
 
@@ -117,19 +141,52 @@ class TestPrepareWorkspace(testtools.TestCase):
             self.assertEqual('cloned-from-cache',
                              project_output['initial_state'])
             self.assertTrue("Cloning into bare" in project_output['clone'])
+            self.assertEqual(cache_mode, project_output['cache_mode'])
+            alternates = os.path.join(dest, '.git', 'objects', 'info',
+                                      'alternates')
+            self.assertEqual(cache_mode == 'shared',
+                             os.path.exists(alternates))
         else:
             self.assertEqual('git-init', project_output['initial_state'])
             self.assertTrue("Initialized empty" in project_output['init'])
         self.assertTrue(project_output['elapsed'] > 0)
 
         output = {}
-        ret = for_each_project(sync_one_project, params, output)
+        timing = {}
+        ret = repo_sync.sync_projects(params, output, timing)
         pprint.pprint(output)
         self.assertTrue(ret)
         project_output = output['example.com/org/test-project']
         self.assertEqual(dest, project_output['dest'])
-        self.assertEqual(1, project_output['attempts'])
+        self.assertEqual(sync_attempts, project_output['attempts'])
         self.assertEqual('', project_output['push'])
+        # The remote refs are only listed ahead of the push when that
+        # doesn't cost another connection.
+        self.assertEqual(ssh_multiplex,
+                         'remote-refs' in project_output['phases'])
+        if cached:
+            # The cache already has everything
+            self.assertEqual(0, project_output['refs'])
+            self.assertEqual(0, project_output['objects'])
+        else:
+            self.assertEqual(1, project_output['refs'])
+            # commit, tree and README blob
+            self.assertEqual(3, project_output['objects'])
+            self.assertTrue(project_output['bytes'] > 0)
+        if ssh_multiplex:
+            self.assertEqual({'enabled': True}, timing['ssh_multiplex'])
+            with open(ssh_log) as f:
+                calls = f.read().splitlines()
+            pprint.pprint(calls)
+            # Master started first, every connection used it, and it
+            # was shut down at the end.
+            self.assertIn('ControlMaster=yes', calls[0])
+            self.assertIn('-O exit', calls[-1])
+            for call in calls[1:-1]:
+                self.assertIn('ControlMaster=no', call)
+            self.assertTrue(len(calls) > 2)
+            control_path = calls[0].split('ControlPath=')[1].split()[0]
+            self.assertFalse(os.path.exists(os.path.dirname(control_path)))
 
         output = {}
         ret = for_each_project(update_one_project, params, output)
@@ -141,6 +198,26 @@ class TestPrepareWorkspace(testtools.TestCase):
                    ).stdout.decode('utf8').strip()
         self.assertEqual('%s init' % (head,), project_output['HEAD'])
         self.assertTrue(project_output['elapsed'] > 0)
+        # Nothing to clean in a freshly prepared repo
+        self.assertEqual(['checkout', 'config', 'log'],
+                         sorted(project_output['phases']))
+        out = run("git config --local --get-regexp receive", cwd=dest,
+                  check=False)
+        self.assertEqual(b'', out.stdout)
+
+        # Dirty the working tree and update again
+        with open(os.path.join(dest, 'README'), 'w') as f:
+            f.write('changed')
+        with open(os.path.join(dest, 'untracked'), 'w') as f:
+            f.write('untracked')
+        output = {}
+        ret = for_each_project(update_one_project, params, output)
+        self.assertTrue(ret)
+        project_output = output['example.com/org/test-project']
+        self.assertIn('clean', project_output['phases'])
+        with open(os.path.join(dest, 'README')) as f:
+            self.assertEqual('test', f.read())
+        self.assertEqual(['.git', 'README'], sorted(os.listdir(dest)))
 
     def test_prepare_workspace_ssh_new(self):
         self._test_prepare_workspace('local', cached=False)
@@ -153,3 +230,354 @@ class TestPrepareWorkspace(testtools.TestCase):
 
     def test_prepare_workspace_k8s_cached(self):
         self._test_prepare_workspace('kubectl', cached=True)
+
+    def test_prepare_workspace_sync_retry(self):
+        attempts = []
+
+        def failing_run(cmd, **kw):
+            if cmd.startswith('git push') and not attempts:
+                attempts.append(cmd)
+                raise Exception("Connection reset")
+            return run(cmd, **kw)
+
+        self.patch(repo_sync, 'run', failing_run)
+        self.patch(repo_sync, 'RETRY_DELAY', 0)
+        self._test_prepare_workspace('local', cached=False,
+                                     sync_attempts=2)
+
+    def test_prepare_workspace_ssh_multiplex(self):
+        self._test_prepare_workspace('local', cached=False,
+                                     ssh_multiplex=True)
+
+    def test_prepare_workspace_ssh_cached_shared(self):
+        self._test_prepare_workspace('local', cached=True,
+                                     cache_mode='shared')
+
+    def test_prepare_workspace_sparse_partial(self):
+        executor_root = self.useFixture(fixtures.TempDir()).path
+        project_root = os.path.join(executor_root,
+                                    'example.com/org/test-project')
+        for path in ('docs', 'src'):
+            os.makedirs(os.path.join(project_root, path))
+        for path in ('README', 'docs/index', 'src/main', 'src/util'):
+            with open(os.path.join(project_root, path), 'w') as f:
+                f.write(path)
+        run("git init .", cwd=project_root)
+        run("git add .", cwd=project_root)
+        run("git -c user.email=user@example.com -c user.name=username "
+            "commit -m init", cwd=project_root)
+        cache_root = self.useFixture(fixtures.TempDir()).path
+        shutil.copytree(executor_root, cache_root, dirs_exist_ok=True)
+
+        work_root = self.useFixture(fixtures.TempDir()).path
+        params = {
+            "ansible_connection": "local",
+            "ansible_host": "testhost",
+            "ansible_port": 22,
+            "ansible_user": "zuul",
+            "cached_repos_root": cache_root,
+            "executor_work_root": executor_root,
+            "inventory_hostname": "testhost",
+            "zuul_workspace_root": work_root,
+            "zuul_projects": {
+                "example.com/org/test-project": {
+                    "canonical_name": "example.com/org/test-project",
+                    "checkout": "master",
+                    "partial_clone": True,
+                    "required": False,
+                    "sparse_checkout": ["/src/"],
+                    "src_dir": "example.com/org/test-project"
+                },
+            },
+        }
+        orig_run = repo_sync.run
+
+        def my_run(*args, **kw):
+            kw.get('env', {}).pop('GIT_ALLOW_PROTOCOL', None)
+            return orig_run(*args, **kw)
+
+        self.patch(repo_sync, 'get_ssh_dest', lambda args, dest: dest)
+        self.patch(repo_sync, 'run', my_run)
+        dest = os.path.join(work_root, 'example.com/org/test-project')
+
+        output = {}
+        self.assertTrue(for_each_project(prep_one_project, params, output))
+        pprint.pprint(output)
+        project_output = output['example.com/org/test-project']
+        self.assertEqual('partial', project_output['cache_mode'])
+        # No blobs at all yet
+        out = run("git rev-list --objects --all --missing=print", cwd=dest)
+        missing = [x for x in out.stdout.decode('utf8').splitlines()
+                   if x.startswith('?')]
+        self.assertEqual(4, len(missing))
+
+        output = {}
+        ret = for_each_project(sync_one_project, params, output)
+        pprint.pprint(output)
+        self.assertTrue(ret)
+        self.assertEqual(0, output['example.com/org/test-project']['refs'])
+
+        output = {}
+        self.assertTrue(for_each_project(update_one_project, params, output))
+        pprint.pprint(output)
+        project_output = output['example.com/org/test-project']
+        self.assertEqual(1, project_output['sparse_checkout'])
+        self.assertEqual(['.git', 'src'], sorted(os.listdir(dest)))
+        self.assertEqual(['main', 'util'],
+                         sorted(os.listdir(os.path.join(dest, 'src'))))
+        # Only the checked out blobs were fetched from the cache
+        out = run("git rev-list --objects --all --missing=print", cwd=dest)
+        missing = [x for x in out.stdout.decode('utf8').splitlines()
+                   if x.startswith('?')]
+        self.assertEqual(2, len(missing))
+
+
+# A stand-in for ssh which runs the remote command locally.  It
+# refuses to use a ControlPath that no master has been started for,
+# and logs its arguments so tests can see which connections were made.
+FAKE_SSH = r"""#!/usr/bin/env python3
+import os
+import subprocess
+import sys
+
+with open(os.environ['FAKE_SSH_LOG'], 'a') as f:
+    f.write(' '.join(sys.argv[1:]) + '\n')
+options = {}
+control = None
+args = sys.argv[1:]
+while args[0].startswith('-'):
+    arg = args.pop(0)
+    if arg in ('-o', '-p', '-E', '-O'):
+        value = args.pop(0)
+        if arg == '-o':
+            key, value = value.split('=', 1)
+            options[key] = value
+        elif arg == '-O':
+            control = value
+path = options.get('ControlPath')
+if control == 'exit':
+    os.unlink(path)
+elif options.get('ControlMaster') == 'yes':
+    open(path, 'w').close()
+else:
+    if path and not os.path.exists(path):
+        sys.exit(255)
+    sys.exit(subprocess.run(' '.join(args[1:]), shell=True).returncode)
+"""
+
+
+class TestRepoSync(testtools.TestCase):
+    def test_get_refspecs(self):
+        local = {'refs/heads/master': 'a', 'refs/heads/new': 'b',
+                 'refs/tags/same': 'c'}
+        remote = {'refs/heads/master': 'x', 'refs/heads/old': 'y',
+                  'refs/tags/same': 'c'}
+        self.assertEqual(['+refs/heads/master:refs/heads/master',
+                          '+refs/heads/new:refs/heads/new',
+                          ':refs/heads/old'],
+                         repo_sync.get_refspecs(local, remote))
+
+    def test_parse_push_output(self):
+        text = ('Enumerating objects: 2, done.\n'
+                'Counting objects:  50% (1/2)\rCounting objects: 100% '
+                '(2/2), done.\n'
+                'Writing objects: 100% (2/2), 1.50 KiB | 1.50 MiB/s, '
+                'done.\n'
+                'Total 2 (delta 0), reused 0 (delta 0), pack-reused 0\n'
+                'remote: hello\n'
+                'To git+ssh://zuul@host:22/src/project\n'
+                '*\trefs/heads/new:refs/heads/new\t[new branch]\n'
+                '+\trefs/heads/master:refs/heads/master\tabc...def '
+                '(forced update)\n'
+                '-\t:refs/heads/old\t[deleted]\n'
+                '=\trefs/tags/same:refs/tags/same\t[up to date]\n'
+                'Done\n')
+        output = {}
+        self.assertEqual('remote: hello',
+                         repo_sync.parse_push_output(text, output))
+        self.assertEqual(3, output['refs'])
+        self.assertEqual(2, output['objects'])
+        self.assertEqual(1536, output['bytes'])
+
+
+class TestRepoConfig(testtools.TestCase):
+    def _make_repos(self, root, count, bare_clone=False):
+        source = os.path.join(root, 'source')
+        run("git init --quiet %s" % (source,))
+        repos = []
+        for i in range(count):
+            dest = os.path.join(root, 'repo%d' % i)
+            if bare_clone:
+                run("git clone --quiet --bare %s %s/.git" % (source, dest))
+            else:
+                run("git init --quiet %s" % (dest,))
+            repos.append(dest)
+        return repos
+
+    def _read_config(self, dest):
+        with open(os.path.join(dest, '.git', 'config')) as f:
+            return f.read()
+
+    def _test_configure_repo(self, bare_clone):
+        root = self.useFixture(fixtures.TempDir()).path
+        fast, slow = self._make_repos(root, 2, bare_clone)
+        configure_repo(fast)
+        configure_repo_with_git(slow)
+        self.assertEqual(self._read_config(slow), self._read_config(fast))
+        out = run("git config --get remote.origin.url", cwd=fast)
+        self.assertEqual('file:///dev/null',
+                         out.stdout.decode('utf8').strip())
+
+    def test_configure_repo_init(self):
+        self._test_configure_repo(bare_clone=False)
+
+    def test_configure_repo_bare_clone(self):
+        self._test_configure_repo(bare_clone=True)
+
+    def test_configure_repo_existing_settings(self):
+        root = self.useFixture(fixtures.TempDir()).path
+        fast, slow = self._make_repos(root, 2)
+        for dest in (fast, slow):
+            run("git config --local receive.denyCurrentBranch refuse",
+                cwd=dest)
+            run("git remote add origin https://example.com/org/project",
+                cwd=dest)
+            run("git config --local user.name username", cwd=dest)
+        configure_repo(fast)
+        configure_repo_with_git(slow)
+        self.assertEqual(self._read_config(slow), self._read_config(fast))
+
+    @testtools.skipUnless(os.environ.get('PREPARE_WORKSPACE_BENCHMARK'),
+                          'Set PREPARE_WORKSPACE_BENCHMARK to run')
+    def test_configure_repo_benchmark(self):
+        # Compare both ways of configuring a synthetic 100 project
+        # workspace.
+        root = self.useFixture(fixtures.TempDir()).path
+        repos = self._make_repos(root, 200)
+        for func, subset in ((configure_repo_with_git, repos[:100]),
+                             (configure_repo, repos[100:])):
+            start = time.monotonic()
+            for dest in subset:
+                func(dest)
+            print('%s: %.3fs for %d repos' % (
+                func.__name__, time.monotonic() - start, len(subset)))
+
+
+class TestForEachProject(testtools.TestCase):
+    def _params(self, count, concurrency):
+        projects = {}
+        for i in range(count):
+            name = 'example.com/org/project%d' % i
+            projects[name] = {'canonical_name': name}
+        return {'concurrency': concurrency, 'zuul_projects': projects}
+
+    def _work(self, args, project, output):
+        start = time.monotonic()
+        with phase(output, 'first'):
+            time.sleep(0.01)
+        with phase(output, 'second'):
+            if project['canonical_name'].endswith('3'):
+                raise Exception("Failed")
+        output['elapsed'] = time.monotonic() - start
+
+    def test_timing_fixed(self):
+        output = {}
+        timing = {}
+        ret = for_each_project(self._work, self._params(5, '2'),
+                               output, timing)
+        pprint.pprint(timing)
+        self.assertFalse(ret)
+        self.assertEqual('Failed',
+                         output['example.com/org/project3']['error'])
+        self.assertEqual({'mode': 'fixed', 'max_workers': 2},
+                         timing['concurrency'])
+        self.assertEqual(4, timing['projects']['count'])
+        self.assertEqual(5, timing['phases']['first']['count'])
+        self.assertEqual(5, timing['phases']['second']['count'])
+        for key in ('p50', 'p95', 'max', 'total'):
+            self.assertIn(key, timing['phases']['first'])
+        self.assertTrue(timing['phases']['first']['p50'] >= 0.01)
+        self.assertTrue(timing['wall_time'] > 0)
+
+    def test_timing_auto(self):
+        output = {}
+        timing = {}
+        ret = for_each_project(self._work, self._params(12, 'auto'),
+                               output, timing)
+        pprint.pprint(timing)
+        self.assertFalse(ret)
+        self.assertEqual('auto', timing['concurrency']['mode'])
+        self.assertTrue(2 <= timing['concurrency']['final'] <=
+                        timing['concurrency']['max_workers'])
+        self.assertEqual(12, timing['phases']['first']['count'])
+
+    def test_default_concurrency(self):
+        output = {}
+        timing = {}
+        ret = for_each_project(self._work, self._params(1, None),
+                               output, timing)
+        self.assertTrue(ret)
+        self.assertEqual(10, timing['concurrency']['max_workers'])
+
+    def test_bad_concurrency(self):
+        self.assertRaises(ValueError, for_each_project,
+                          self._work, self._params(1, '0'), {})
+        self.assertRaises(ValueError, check_concurrency, 'many')
+        check_concurrency('auto')
+        check_concurrency('4')
+        check_concurrency(None)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestAdaptiveLimiter(testtools.TestCase):
+    def _limiter(self, initial, minimum, maximum):
+        clock = FakeClock()
+        self.patch(AdaptiveLimiter, 'clock', clock)
+        return AdaptiveLimiter(initial, minimum, maximum), clock
+
+    def _run(self, limiter, clock, windows, duration):
+        # Finish windows of projects, with more always queued behind
+        # them.  duration(limit, projects) is the time a window takes,
+        # given the indexes of the projects finished in it.
+        count = 0
+        for window in range(windows):
+            limit = limiter.limit
+            for i in range(limit):
+                limiter.acquire()
+            limiter.queued = True
+            clock.now += duration(limit, range(count, count + limit))
+            count += limit
+            for i in range(limit):
+                limiter.release()
+
+    def test_mixed_sizes(self):
+        # Without contention, the time a window takes only depends on
+        # the size of the repos in it; a few large ones must not
+        # shrink the limit.
+        sizes = [0.1, 0.2, 0.2, 0.5, 1.0, 0.1, 5.0, 0.3, 0.1, 0.2, 2.0]
+
+        def duration(limit, projects):
+            return sum(sizes[i % len(sizes)] for i in projects) / limit
+
+        limiter, clock = self._limiter(8, 2, 32)
+        self._run(limiter, clock, 60, duration)
+        self.assertTrue(limiter.limit >= 24, limiter.limit)
+        self.assertEqual(0, limiter.active)
+
+    def test_contention(self):
+        # Above 6 workers, each one added slows every project down
+        # enough that fewer are finished per second.
+        def duration(limit, projects):
+            return limit / 6.0 * max(1, (limit / 6.0) ** 2)
+
+        limiter, clock = self._limiter(4, 2, 32)
+        self._run(limiter, clock, 60, duration)
+        self.assertTrue(5 <= limiter.limit <= 7, limiter.limit)
+        self.assertTrue(limiter.peak <= 8, limiter.peak)
@@ -12,10 +12,21 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import contextlib
+import math
+import os
+import re
 import shlex
 import subprocess
+import threading
+import time
 from concurrent.futures import ThreadPoolExecutor
 
+DEFAULT_CONCURRENCY = 10
+
+GIT_CONFIG_SECTION_RE = re.compile(r'^\s*\[\s*([^\s\]"]+)(?:\s+"(.*)")?\s*\]')
+GIT_CONFIG_KEY_RE = re.compile(r'^\s*([A-Za-z][A-Za-z0-9-]*)\s*(=|$)')
+
 
 def run(cmd, shell=False, cwd=None, check=True, env=None):
     if not shell:
@@ -26,18 +37,241 @@ def run(cmd, shell=False, cwd=None, check=True, env=None):
                           check=check)
 
 
-def for_each_project(func, args, output):
+def read_git_config(dest):
+    # Split the .git/config of a repo into [(section, subsection),
+    # lines] chunks, the first of which holds anything before a header.
+    # This lets us change a few settings without running git for each.
+    sections = [[None, []]]
+    with open(os.path.join(dest, '.git', 'config')) as f:
+        for line in f:
+            m = GIT_CONFIG_SECTION_RE.match(line)
+            if m:
+                sections.append([(m.group(1).lower(), m.group(2)), [line]])
+            else:
+                sections[-1][1].append(line)
+    return sections
+
+
+def write_git_config(dest, sections):
+    path = os.path.join(dest, '.git', 'config')
+    tmp = path + '.zuul.tmp'
+    with open(tmp, 'w') as f:
+        f.write(''.join(''.join(lines) for _, lines in sections))
+    os.rename(tmp, path)
+
+
+def _is_git_config_key(line, key):
+    m = GIT_CONFIG_KEY_RE.match(line)
+    return m and m.group(1).lower() == key.lower()
+
+
+def set_git_config(sections, section, subsection, key, value):
+    # Replace the key in place if it is set, otherwise append it to the
+    # last matching section, as "git config" does.
+    new_line = '\t%s = %s\n' % (key, value)
+    matching = [s for s in sections if s[0] == (section, subsection)]
+    for _, lines in matching:
+        for i, line in enumerate(lines[1:], 1):
+            if _is_git_config_key(line, key):
+                lines[i] = new_line
+                return
+    if not matching:
+        if subsection is None:
+            header = '[%s]\n' % (section,)
+        else:
+            header = '[%s "%s"]\n' % (section, subsection)
+        matching = [[(section, subsection), [header]]]
+        sections.extend(matching)
+    lines = matching[-1][1]
+    if lines and not lines[-1].endswith('\n'):
+        lines[-1] += '\n'
+    lines.append(new_line)
+
+
+def unset_git_config(sections, section, subsection, key):
+    # Like "git config --unset", this leaves the section header behind.
+    for name, lines in sections:
+        if name == (section, subsection):
+            lines[1:] = [line for line in lines[1:]
+                         if not _is_git_config_key(line, key)]
+
+
+@contextlib.contextmanager
+def phase(output, name):
+    # Record how long a step of the per-project work took; these are
+    # aggregated across projects by summarize_timing.
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        phases = output.setdefault('phases', {})
+        phases[name] = phases.get(name, 0) + time.monotonic() - start
+
+
+class AdaptiveLimiter:
+    # Bound the number of projects worked on at once.  Projects vary a
+    # lot in size, so their latencies can't be compared with each
+    # other; instead the throughput (projects finished per second) is
+    # tallied for every limit tried.  Each time `limit` projects have
+    # finished, the limit grows if projects were queued, unless it does
+    # worse than the limit below it (e.g. disk or network contention).
+    # In that case it steps back down and doesn't grow past that again
+    # for a while, as one slow window may just have been large repos.
+    degrade_ratio = 0.8
+    ceiling_windows = 8
+    clock = staticmethod(time.monotonic)
+
+    def __init__(self, initial, minimum, maximum):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = max(minimum, min(initial, maximum))
+        self.peak = self.limit
+        self.active = 0
+        self.waiting = 0
+        self.queued = False
+        self.completed = 0
+        self.window_start = self.clock()
+        # limit -> [projects finished, seconds spent]
+        self.tally = {}
+        self.ceiling = maximum
+        self.ceiling_age = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while self.active >= self.limit:
+                self.queued = True
+                self.waiting += 1
+                self.cond.wait()
+                self.waiting -= 1
+            self.active += 1
+
+    def _rate(self, limit):
+        finished, spent = self.tally[limit]
+        return finished / max(spent, 1e-6)
+
+    def _adjust(self):
+        now = self.clock()
+        tally = self.tally.setdefault(self.limit, [0, 0.0])
+        tally[0] += self.completed
+        tally[1] += now - self.window_start
+        self.ceiling_age += 1
+        if self.ceiling_age >= self.ceiling_windows:
+            self.ceiling = self.maximum
+        lower = self.limit - 1
+        if (lower in self.tally and
+                self._rate(self.limit) <
+                self._rate(lower) * self.degrade_ratio):
+            self.limit = max(self.minimum, lower)
+            self.ceiling = self.limit
+            self.ceiling_age = 0
+        elif self.queued and self.limit < self.ceiling:
+            self.limit += 1
+        self.peak = max(self.peak, self.limit)
+        self.completed = 0
+        self.queued = self.waiting > 0
+        self.window_start = now
+
+    def release(self):
+        with self.cond:
+            self.active -= 1
+            self.completed += 1
+            if self.completed >= self.limit:
+                self._adjust()
+            self.cond.notify_all()
+
+
+def check_concurrency(value):
+    # Raises ValueError unless value is empty, "auto" or a positive
+    # integer, so that modules can fail before starting any work.
+    if value is None or value == '' or str(value).lower() == 'auto':
+        return
+    try:
+        workers = int(value)
+    except ValueError:
+        workers = 0
+    if workers < 1:
+        raise ValueError("concurrency must be a positive integer or "
+                         "'auto', not %r" % (value,))
+
+
+def get_concurrency(value, count):
+    # Returns the worker count for a fixed setting, or an
+    # AdaptiveLimiter when value is "auto".
+    check_concurrency(value)
+    if value is None or value == '':
+        return DEFAULT_CONCURRENCY, None
+    if str(value).lower() == 'auto':
+        cpus = os.cpu_count() or 1
+        maximum = max(2, min(cpus * 4, 32, count))
+        return maximum, AdaptiveLimiter(cpus, 2, maximum)
+    return int(value), None
+
+
+def _percentile(values, pct):
+    # Nearest-rank percentile of a sorted list
+    index = max(0, math.ceil(pct / 100.0 * len(values)) - 1)
+    return values[index]
+
+
+def _stats(values):
+    values = sorted(values)
+    if not values:
+        return dict(count=0)
+    return dict(count=len(values),
+                total=sum(values),
+                p50=_percentile(values, 50),
+                p95=_percentile(values, 95),
+                max=values[-1])
+
+
+def summarize_timing(output, timing):
+    # Aggregate the per-project 'elapsed' and 'phases' values
+    elapsed = []
+    phases = {}
+    for project_out in output.values():
+        if 'elapsed' in project_out:
+            elapsed.append(project_out['elapsed'])
+        for name, value in project_out.get('phases', {}).items():
+            phases.setdefault(name, []).append(value)
+    timing['projects'] = _stats(elapsed)
+    timing['phases'] = {name: _stats(values)
+                        for name, values in phases.items()}
+    slowest = sorted(output.items(),
+                     key=lambda x: x[1].get('elapsed', 0), reverse=True)
+    timing['slowest'] = [(name, project_out.get('elapsed'))
+                         for name, project_out in slowest[:5]]
+    return timing
+
+
+def for_each_project(func, args, output, timing=None):
     # Run a function for each zuul project in a threadpool executor.
     # An output dictionary specific to that project is passed to the
-    # function.
+    # function.  If a timing dictionary is supplied, it is filled with
+    # the concurrency used and aggregated timing statistics.
     success = True
-    with ThreadPoolExecutor(max_workers=10) as executor:
+    start = time.monotonic()
+    projects = list(args['zuul_projects'].values())
+    max_workers, limiter = get_concurrency(args.get('concurrency'),
+                                           len(projects))
+
+    def limited(project, project_out):
+        limiter.acquire()
+        try:
+            func(args, project, project_out)
+        finally:
+            limiter.release()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
         futures = []
-        for project in args['zuul_projects'].values():
+        for project in projects:
             project_out = {}
             output[project['canonical_name']] = project_out
-            f = executor.submit(
-                func, args, project, project_out)
+            if limiter:
+                f = executor.submit(limited, project, project_out)
+            else:
+                f = executor.submit(
+                    func, args, project, project_out)
             futures.append((project_out, f))
         for (project_out, f) in futures:
             try:
@@ -50,4 +284,15 @@ def for_each_project(func, args, output):
                     msg = str(e)
                 project_out['error'] = msg
                 success = False
+    if timing is not None:
+        timing['wall_time'] = time.monotonic() - start
+        if limiter:
+            timing['concurrency'] = dict(mode='auto',
+                                         max_workers=max_workers,
+                                         peak=limiter.peak,
+                                         final=limiter.limit)
+        else:
+            timing['concurrency'] = dict(mode='fixed',
+                                         max_workers=max_workers)
+        summarize_timing(output, timing)
     return success
@@ -0,0 +1,224 @@
+# Copyright (c) 2017 Red Hat
+#
+# This module is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import os
+import subprocess
+
+import fixtures
+import testtools
+
+from . import zuul_debug_info
+from .zuul_debug_info import get_disks, hash_fingerprint, parse_cpuinfo
+from .zuul_debug_info import run_all, run_command, timed
+
+
+X86_CPUINFO = """\
+processor\t: 0
+vendor_id\t: GenuineIntel
+model name\t: Intel(R) Xeon(R) CPU E5-2680 v4 @ 2.40GHz
+flags\t\t: sse2 fpu vmx
+
+processor\t: 1
+vendor_id\t: GenuineIntel
+model name\t: Intel(R) Xeon(R) CPU E5-2680 v4 @ 2.40GHz
+flags\t\t: sse2 fpu vmx
+"""
+
+ARM_CPUINFO = """\
+processor\t: 0
+BogoMIPS\t: 100.00
+Features\t: fp asimd evtstrm aes
+
+processor\t: 1
+BogoMIPS\t: 100.00
+Features\t: fp asimd evtstrm aes
+
+Hardware\t: BCM2835
+"""
+
+
+def fail(message):
+    raise RuntimeError(message)
+
+
+class TestRunAll(testtools.TestCase):
+
+    def test_timed(self):
+        '''Test that an exception is returned with its traceback'''
+        result, error, duration = timed(len, 'abc')
+        self.assertEqual(3, result)
+        self.assertIsNone(error)
+        self.assertGreaterEqual(duration, 0)
+
+        result, error, duration = timed(fail, 'broken')
+        self.assertIsNone(result)
+        e, tb = error
+        self.assertIsInstance(e, RuntimeError)
+        self.assertIn('RuntimeError: broken', tb)
+        self.assertIn('in fail', tb)
+
+    def _check_run_all(self):
+        results = run_all({
+            'echo': (run_command, 'echo ok', 10),
+            'false': (run_command, 'false', 10),
+            'missing': (run_command, 'no-such-command-here', 10),
+            'fail': (fail, 'broken'),
+        })
+        self.assertEqual(['echo', 'fail', 'false', 'missing'],
+                         sorted(results))
+        result, error, _ = results['echo']
+        self.assertEqual(b'ok\n', result)
+        self.assertIsNone(error)
+        e, _ = results['false'][1]
+        self.assertIsInstance(e, subprocess.CalledProcessError)
+        self.assertEqual(1, e.returncode)
+        e, _ = results['missing'][1]
+        self.assertIsInstance(e, OSError)
+        e, _ = results['fail'][1]
+        self.assertIsInstance(e, RuntimeError)
+
+    def test_run_all(self):
+        '''Test that failing jobs don't hide the other results'''
+        self._check_run_all()
+
+    def test_run_all_serial(self):
+        '''Test the jobs without concurrent.futures'''
+        self.patch(zuul_debug_info, 'concurrent', None)
+        self._check_run_all()
+
+    def test_timeout(self):
+        '''Test that a command is aborted after its timeout'''
+        result, error, duration = timed(run_command, 'sleep 10', 0.1)
+        self.assertIsNone(result)
+        self.assertIsInstance(error[0], subprocess.TimeoutExpired)
+        self.assertLess(duration, 5)
+
+
+class FakeModule(object):
+    params = {}
+
+    class Exit(Exception):
+        pass
+
+    def __init__(self, argument_spec):
+        self.params = dict((name, spec.get('default'))
+                           for name, spec in argument_spec.items())
+        self.params.update(FakeModule.params)
+
+    def exit_json(self, **kw):
+        raise self.Exit(kw)
+
+    fail_json = exit_json
+
+
+class TestFingerprint(testtools.TestCase):
+
+    def test_parse_cpuinfo_x86(self):
+        self.assertEqual({
+            'model': 'Intel(R) Xeon(R) CPU E5-2680 v4 @ 2.40GHz',
+            'flags': ['fpu', 'sse2', 'vmx'],
+            'count': 2,
+        }, parse_cpuinfo(X86_CPUINFO))
+
+    def test_parse_cpuinfo_arm(self):
+        self.assertEqual({
+            'model': 'BCM2835',
+            'flags': ['aes', 'asimd', 'evtstrm', 'fp'],
+            'count': 2,
+        }, parse_cpuinfo(ARM_CPUINFO))
+
+    def test_hash_fingerprint(self):
+        '''Test that the hash doesn't depend on the order of the keys'''
+        items = [('kernel', ['Linux']), ('memory', 1024),
+                 ('disks', collections.OrderedDict([('vda', 1), ('vdb', 2)]))]
+        reordered = [('disks', collections.OrderedDict([('vdb', 2),
+                                                        ('vda', 1)])),
+                     ('memory', 1024), ('kernel', ['Linux'])]
+        self.assertEqual(
+            hash_fingerprint(collections.OrderedDict(items)),
+            hash_fingerprint(collections.OrderedDict(reordered)))
+        self.assertNotEqual(
+            hash_fingerprint(dict(items)),
+            hash_fingerprint(dict(items, memory=2048)))
+
+    def test_get_disks(self):
+        '''Test that only the fixed block devices are listed'''
+        root = self.useFixture(fixtures.TempDir()).path
+        for name, device, removable in (('vda', True, '0'),
+                                        ('sdb', True, '0'),
+                                        ('sr0', True, '1'),
+                                        ('dm-0', False, '0'),
+                                        ('zram0', False, '0'),
+                                        ('nbd0', False, '0'),
+                                        ('loop0', False, '0')):
+            path = os.path.join(root, name)
+            os.mkdir(path)
+            if device:
+                os.mkdir(os.path.join(path, 'device'))
+            with open(os.path.join(path, 'removable'), 'w') as f:
+                f.write(removable + '\n')
+            with open(os.path.join(path, 'size'), 'w') as f:
+                f.write('2048\n')
+        self.assertEqual({'sdb': 2048 * 512, 'vda': 2048 * 512},
+                         get_disks(root))
+        self.assertEqual({}, get_disks(os.path.join(root, 'missing')))
+
+    def setUp(self):
+        super(TestFingerprint, self).setUp()
+        tmp = self.useFixture(fixtures.TempDir()).path
+        self.manifest = os.path.join(tmp, 'dib-builddate.txt')
+        with open(self.manifest, 'w') as f:
+            f.write('2024-01-01 00:00\n')
+
+    def _main(self, **params):
+        def fake_run_all(jobs):
+            results = dict((name, (name.encode('utf8'), None, 0.0))
+                           for name in jobs)
+            results['proc_cpuinfo'] = (X86_CPUINFO.encode('utf8'), None, 0.0)
+            return results
+
+        self.patch(zuul_debug_info, 'run_all', fake_run_all)
+        self.patch(zuul_debug_info, 'AnsibleModule', FakeModule)
+        self.patch(FakeModule, 'params',
+                   dict(params, image_manifest_files=[self.manifest]))
+        e = self.assertRaises(FakeModule.Exit, zuul_debug_info.main)
+        return e.args[0]
+
+    def test_main_fingerprint(self):
+        '''Test that the static output is only left out on a match'''
+        full = self._main()
+        self.assertNotIn('fingerprint_unchanged', full)
+        self.assertEqual(b'uname', full['uname'])
+        self.assertEqual(X86_CPUINFO.encode('utf8'), full['proc_cpuinfo'])
+        self.assertEqual(1, len(full['image_manifest_files']))
+        self.assertEqual(hash_fingerprint(full['fingerprint']),
+                         full['fingerprint_hash'])
+
+        ret = self._main(fingerprint_hash='0' * 64)
+        self.assertEqual(full, ret)
+
+        ret = self._main(fingerprint_hash=full['fingerprint_hash'])
+        self.assertTrue(ret['fingerprint_unchanged'])
+        self.assertEqual(full['fingerprint_hash'], ret['fingerprint_hash'])
+        for key in ('fingerprint', 'uname', 'proc_cpuinfo'):
+            self.assertNotIn(key, ret)
+        self.assertEqual([], ret['image_manifest_files'])
+        # Everything else is still there
+        self.assertEqual(b'df_m', ret['df_m'])
+        self.assertEqual(
+            sorted(set(full) - set(['fingerprint', 'uname',
+                                    'proc_cpuinfo'])),
+            sorted(set(ret) - set(['fingerprint_unchanged'])))
@@ -13,11 +13,31 @@
 # You should have received a copy of the GNU General Public License
 # along with this software.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
+import json
 import os
 import shlex
 import subprocess
 import traceback
 
+# The module still runs with Python 2.7: the commands are not timed
+# out there, and without the concurrent.futures backport they run one
+# after the other.
+try:
+    import concurrent.futures
+except ImportError:
+    concurrent = None
+
+try:
+    from os import cpu_count
+except ImportError:
+    from multiprocessing import cpu_count
+
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
 
 command_map = {
     'uname': 'uname -a',
@@ -27,17 +47,148 @@ command_map = {
     'network_neighbors': 'ip neighbor show',
     'df_i': 'df -i',
     'df_m': 'df -m',
-    'proc_cpuinfo': 'cat /proc/cpuinfo',
+}
+
+# Read directly instead of spawning cat
+file_map = {
+    'proc_cpuinfo': '/proc/cpuinfo',
 }
 
 
-def run_command(command):
+# Output which only depends on the kind of host, and is left out when
+# the caller already knows its fingerprint.
+static_keys = ('uname', 'proc_cpuinfo')
+
+
+def run_command(command, timeout=None):
     env = os.environ.copy()
     env['PATH'] = '{path}:/sbin:/usr/sbin'.format(path=env['PATH'])
+    kwargs = {}
+    if timeout is not None and hasattr(subprocess, 'TimeoutExpired'):
+        kwargs['timeout'] = timeout
     return subprocess.check_output(
         shlex.split(command),
         stderr=subprocess.STDOUT,
-        env=env)
+        env=env,
+        **kwargs)
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def timed(func, *args):
+    # Returns the result of func (or None), the exception it raised (or
+    # None) along with its traceback, and how long it took.
+    start = monotonic()
+    try:
+        result, error = func(*args), None
+    except Exception as e:
+        result, error = None, (e, traceback.format_exc())
+    return result, error, monotonic() - start
+
+
+def parse_cpuinfo(cpuinfo):
+    model = None
+    flags = []
+    count = 0
+    for line in cpuinfo.splitlines():
+        key, sep, value = line.partition(':')
+        if not sep:
+            continue
+        key = key.strip()
+        value = value.strip()
+        if key == 'processor':
+            count += 1
+        elif key in ('model name', 'cpu model', 'Hardware') and not model:
+            model = value
+        elif key in ('flags', 'Features') and not flags:
+            flags = sorted(value.split())
+    return {'model': model, 'flags': flags, 'count': count or cpu_count()}
+
+
+def get_memory():
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemTotal:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def get_disks(sys_block='/sys/block'):
+    # Only the disks of the flavor: virtual devices (loop, dm, zram,
+    # nbd...) have no device, and removable ones (like an attached
+    # config drive) can come and go.
+    disks = {}
+    try:
+        names = os.listdir(sys_block)
+    except OSError:
+        return disks
+    for name in sorted(names):
+        path = os.path.join(sys_block, name)
+        if not os.path.exists(os.path.join(path, 'device')):
+            continue
+        try:
+            with open(os.path.join(path, 'removable')) as f:
+                if f.read().strip() != '0':
+                    continue
+            with open(os.path.join(path, 'size')) as f:
+                # Always in 512 byte sectors
+                disks[name] = int(f.read()) * 512
+        except (IOError, OSError, ValueError):
+            pass
+    return disks
+
+
+def get_nics():
+    try:
+        return sorted(n for n in os.listdir('/sys/class/net') if n != 'lo')
+    except OSError:
+        return []
+
+
+def _to_bytes(text):
+    # Files are read as bytes on Python 2
+    if isinstance(text, bytes):
+        return text
+    return text.encode('utf8')
+
+
+def get_fingerprint(cpuinfo, image_manifest_files):
+    # Only what is the same on every node booted from the same image
+    # with the same flavor: no host names, addresses or timestamps.
+    # A plain tuple on Python 2
+    uname = os.uname()
+    return {
+        'kernel': [uname[0], uname[2], uname[3], uname[4]],
+        'cpu': parse_cpuinfo(cpuinfo.decode('utf8', 'replace')),
+        'memory': get_memory(),
+        'disks': get_disks(),
+        'nics': get_nics(),
+        'image': dict(
+            (m['filename'],
+             hashlib.sha256(_to_bytes(m['content'])).hexdigest())
+            for m in image_manifest_files),
+    }
+
+
+def hash_fingerprint(fingerprint):
+    data = json.dumps(fingerprint, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(data.encode('utf8')).hexdigest()
+
+
+def run_all(jobs):
+    # Run all the {name: (func, args...)} jobs at the same time
+    if concurrent is None:
+        return dict((name, timed(*job)) for name, job in jobs.items())
+    with concurrent.futures.ThreadPoolExecutor(len(jobs)) as executor:
+        futures = dict((name, executor.submit(timed, *job))
+                       for name, job in jobs.items())
+    return dict((name, future.result()) for name, future in futures.items())
 
 
 def main():
@@ -48,6 +199,9 @@ def main():
             image_manifest=dict(required=False, type='str'),
             image_manifest_files=dict(required=False, type='list'),
             traceroute_host=dict(required=False, type='str'),
+            traceroute_timeout=dict(required=False, type='int'),
+            command_timeout=dict(required=False, type='int', default=60),
+            fingerprint_hash=dict(required=False, type='str'),
         )
     )
 
@@ -55,6 +209,8 @@ def main():
     ipv6_route_required = module.params['ipv6_route_required']
     image_manifest = module.params['image_manifest']
     traceroute_host = module.params['traceroute_host']
+    traceroute_timeout = module.params['traceroute_timeout']
+    command_timeout = module.params['command_timeout']
     image_manifest_files = module.params['image_manifest_files']
     if not image_manifest_files and image_manifest:
         image_manifest_files = [image_manifest]
@@ -68,48 +224,68 @@ def main():
                 'underline': len(image_manifest) * '-',
                 'content': open(image_manifest, 'r').read(),
             })
+    # The traceroutes can take a long time on a broken network, so
+    # everything runs concurrently.
+    jobs = {}
     if traceroute_host:
-        v6_passed = False
-        try:
-            ret['traceroute_v6'] = run_command(
-                'traceroute6 -n {host}'.format(host=traceroute_host))
-            v6_passed = True
-        except (subprocess.CalledProcessError, OSError) as e:
-            ret['traceroute_v6_exception'] = traceback.format_exc()
-            ret['traceroute_v6_output'] = e.output
-            ret['traceroute_v6_return'] = e.returncode
-            pass
-        v4_passed = False
-        try:
-            ret['traceroute_v4'] = run_command(
-                'traceroute -n {host}'.format(host=traceroute_host))
-            v4_passed = True
-        except (subprocess.CalledProcessError, OSError) as e:
-            ret['traceroute_v4_exception'] = traceback.format_exc()
-            ret['traceroute_v4_output'] = e.output
-            ret['traceroute_v4_return'] = e.returncode
-            pass
-        if v6_passed or v4_passed:
-            # By default, only require one IP family to have a working route,
-            # either version will suffice
-            passed = True
-        if ipv6_route_required and not v6_passed:
+        jobs['traceroute_v6'] = (
+            run_command, 'traceroute6 -n {host}'.format(host=traceroute_host),
+            traceroute_timeout)
+        jobs['traceroute_v4'] = (
+            run_command, 'traceroute -n {host}'.format(host=traceroute_host),
+            traceroute_timeout)
+    for key, command in command_map.items():
+        jobs[key] = (run_command, command, command_timeout)
+    for key, path in file_map.items():
+        jobs[key] = (read_file, path)
+    results = run_all(jobs)
+    ret['durations'] = dict((key, round(duration, 3))
+                            for key, (_, _, duration) in results.items())
+    ret['fingerprint'] = get_fingerprint(
+        results['proc_cpuinfo'][0] or b'', ret['image_manifest_files'])
+    ret['fingerprint_hash'] = hash_fingerprint(ret['fingerprint'])
+    unchanged = module.params['fingerprint_hash'] == ret['fingerprint_hash']
+
+    if traceroute_host:
+        passed = {}
+        for version in ('v6', 'v4'):
+            key = 'traceroute_' + version
+            result, error, _ = results.pop(key)
+            passed[version] = error is None
+            if error is None:
+                ret[key] = result
+            else:
+                e, tb = error
+                ret[key + '_exception'] = tb
+                ret[key + '_output'] = getattr(e, 'output', None)
+                ret[key + '_return'] = getattr(e, 'returncode', None)
+        # By default, only require one IP family to have a working route,
+        # either version will suffice
+        ok = passed['v6'] or passed['v4']
+        if ipv6_route_required and not passed['v6']:
             # Override the result if IPv6 is explicitly required
-            passed = False
-        if ipv4_route_required and not v4_passed:
+            ok = False
+        if ipv4_route_required and not passed['v4']:
             # Override the result if IPv4 is explicitly required
-            passed = False
-        if not passed:
+            ok = False
+        if not ok:
             module.fail_json(
                 msg="The required v4 or v6 route to {traceroute_host} was not"
                     " found. The build node is assumed to be invalid.".format(
                         traceroute_host=traceroute_host), **ret)
 
-    for key, command in command_map.items():
-        try:
-            ret[key] = run_command(command)
-        except subprocess.CalledProcessError:
-            pass
+    for key, (result, error, _) in results.items():
+        if error is None:
+            ret[key] = result
+
+    if unchanged:
+        # The caller already has the static output for this kind of
+        # host, so don't send it again.
+        ret['fingerprint_unchanged'] = True
+        del ret['fingerprint']
+        for key in static_keys:
+            ret.pop(key, None)
+        ret['image_manifest_files'] = []
 
     module.exit_json(changed=False, _zuul_nolog_return=True, **ret)
 
@@ -14,12 +14,57 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
+import json
 import os
 import re
+import shutil
+import stat
+
+
+def get_git_head(root):
+    # Resolve HEAD without running git
+    git_dir = os.path.join(root, '.git')
+    try:
+        with open(os.path.join(git_dir, 'HEAD')) as f:
+            head = f.read().strip()
+    except OSError:
+        return None
+    if not head.startswith('ref: '):
+        return head
+    ref = head[len('ref: '):]
+    try:
+        with open(os.path.join(git_dir, ref)) as f:
+            return f.read().strip()
+    except OSError:
+        pass
+    try:
+        with open(os.path.join(git_dir, 'packed-refs')) as f:
+            for line in f:
+                if line.rstrip('\n').endswith(' ' + ref):
+                    return line.split()[0]
+    except OSError:
+        pass
+    return head
+
+
+def get_settings_key(settings):
+    # Identifies the version of a devstack plugin settings file, or
+    # None if there is no such file.  A checkout of another commit may
+    # keep the mtime of the file, so the commit is part of it.
+    try:
+        st = os.stat(settings)
+    except OSError:
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    root = os.path.dirname(os.path.dirname(settings))
+    return [st.st_mtime_ns, get_git_head(root)]
 
 
 class DependencyGraph(object):
-    # This is based on the JobGraph from Zuul.
+    # This is based on the JobGraph from Zuul.  All the edges are added
+    # first; checkCycles then validates the whole graph in one pass.
 
     def __init__(self):
         self._names = set()
@@ -28,48 +73,61 @@ class DependencyGraph(object):
     def add(self, name, dependencies):
         # Append the dependency information
         self._dependencies.setdefault(name, set())
-        try:
-            for dependency in dependencies:
-                # Make sure a circular dependency is never created
-                ancestors = self._getParentNamesRecursively(
-                    dependency, soft=True)
-                ancestors.add(dependency)
-                if name in ancestors:
-                    raise Exception("Dependency cycle detected in {}".
-                                    format(name))
-                self._dependencies[name].add(dependency)
-        except Exception:
-            del self._dependencies[name]
-            raise
-
-    def getDependenciesRecursively(self, parent):
-        dependencies = []
-
-        current_dependencies = self._dependencies[parent]
-        for current in current_dependencies:
-            if current not in dependencies:
-                dependencies.append(current)
-            for dep in self.getDependenciesRecursively(current):
-                if dep not in dependencies:
-                    dependencies.append(dep)
-        return dependencies
-
-    def _getParentNamesRecursively(self, dependent, soft=False):
-        all_parent_items = set()
-        items_to_iterate = set([dependent])
-        while len(items_to_iterate) > 0:
-            current_item = items_to_iterate.pop()
-            current_parent_items = self._dependencies.get(current_item)
-            if current_parent_items is None:
-                if soft:
-                    current_parent_items = set()
-                else:
-                    raise Exception("Dependent item {} not found: ".format(
-                                    dependent))
-            new_parent_items = current_parent_items - all_parent_items
-            items_to_iterate |= new_parent_items
-            all_parent_items |= new_parent_items
-        return all_parent_items
+        for dependency in dependencies:
+            self._dependencies[name].add(dependency)
+
+    def checkCycles(self):
+        # Kahn's algorithm: repeatedly remove the items whose
+        # dependencies have all been removed.  Whatever is left is part
+        # of, or depends on, a cycle.
+        pending = {}
+        dependents = {}
+        for name, parents in self._dependencies.items():
+            pending[name] = len(parents)
+            for parent in parents:
+                dependents.setdefault(parent, []).append(name)
+        ready = [name for name, count in pending.items() if not count]
+        # Dependencies which were never added have nothing to wait for
+        ready.extend(parent for parent in dependents
+                     if parent not in pending)
+        while ready:
+            for name in dependents.get(ready.pop(), ()):
+                pending[name] -= 1
+                if not pending[name]:
+                    ready.append(name)
+        cycle = sorted(name for name, count in pending.items() if count)
+        if cycle:
+            raise Exception("Dependency cycle detected in {}".format(
+                ", ".join(cycle)))
+
+    def _walkDependencies(self, parent, seen, ret):
+        # Append the dependencies of parent not in seen to ret, each
+        # followed by its own dependencies (depth first, in set order).
+        stack = list(self._dependencies[parent])
+        stack.reverse()
+        while stack:
+            current = stack.pop()
+            if current in seen:
+                continue
+            seen.add(current)
+            ret.append(current)
+            parents = list(self._dependencies[current])
+            parents.reverse()
+            stack.extend(parents)
+
+    def getOrder(self, keys):
+        # Each of keys, preceded by those of its dependencies which are
+        # not already listed.  Anything seen before had all of its own
+        # dependencies listed then, so they are not walked again.
+        ret = []
+        seen = set()
+        for key in keys:
+            if key in seen:
+                continue
+            self._walkDependencies(key, seen, ret)
+            seen.add(key)
+            ret.append(key)
+        return ret
 
 
 class VarGraph(DependencyGraph):
@@ -81,6 +139,7 @@ class VarGraph(DependencyGraph):
             self._varnames.add(k)
         for k, v in vars.items():
             self._addVar(k, str(v))
+        self.checkCycles()
 
     bash_var_re = re.compile(r'\$\{?(\w+)')
     def getDependencies(self, value):
@@ -102,32 +161,32 @@ class VarGraph(DependencyGraph):
                 # external variable.
                 continue
             dependencies.add(dependency)
-        try:
-            self.add(key, dependencies)
-        except Exception:
-            del self.vars[key]
-            raise
+        self.add(key, dependencies)
 
     def getVars(self):
-        ret = []
-        keys = sorted(self.vars.keys())
-        seen = set()
-        for key in keys:
-            dependencies = self.getDependenciesRecursively(key)
-            for var in dependencies + [key]:
-                if var not in seen:
-                    ret.append((var, self.vars[var]))
-                    seen.add(var)
-        return ret
+        return [(var, self.vars[var])
+                for var in self.getOrder(sorted(self.vars.keys()))]
 
 
 class PluginGraph(DependencyGraph):
-    def __init__(self, base_dir, plugins):
+    # How deep below base_dir to look for git repos when the plugins
+    # can't all be found in the projects of the job.
+    max_search_depth = 3
+
+    def __init__(self, base_dir, plugins, projects=None, cache_path=None):
         super(PluginGraph, self).__init__()
         # The dependency trees expressed by all the plugins we found
         # (which may be more than those the job is using).
         self._plugin_dependencies = {}
-        self.loadPluginNames(base_dir)
+        self._defined_plugins = set()
+        # The settings files read, and their get_settings_key
+        self.settings = {}
+        self._cache_path = cache_path
+        self._cache = {}
+        self._cache_changed = False
+        self.loadPluginNames(base_dir, projects, plugins)
+        # The plugins whose settings were not found anywhere
+        self.unresolved = sorted(set(plugins) - self._defined_plugins)
 
         self.plugins = {}
         self._pluginnames = set()
@@ -135,40 +194,112 @@ class PluginGraph(DependencyGraph):
             self._pluginnames.add(k)
         for k, v in plugins.items():
             self._addPlugin(k, str(v))
+        self.checkCycles()
 
-    def loadPluginNames(self, base_dir):
+    def loadPluginNames(self, base_dir, projects=None, plugins=()):
         if base_dir is None:
             return
+        self._loadCache()
+        # The projects of the job are copied to base_dir by
+        # setup-devstack-source-dirs, so look there first.
         git_roots = []
-        for root, dirs, files in os.walk(base_dir):
-            if '.git' not in dirs:
-                continue
-            # Don't go deeper than git roots
-            dirs[:] = []
-            git_roots.append(root)
+        for project in (projects or {}).values():
+            root = os.path.join(base_dir, project['short_name'])
+            if os.path.isdir(os.path.join(root, '.git')):
+                git_roots.append(root)
         for root in git_roots:
-            devstack = os.path.join(root, 'devstack')
-            if not (os.path.exists(devstack) and os.path.isdir(devstack)):
+            self.loadGitRoot(root)
+        if not self._defined_plugins.issuperset(plugins):
+            for root in self.findGitRoots(base_dir):
+                if root not in git_roots:
+                    self.loadGitRoot(root)
+        self._saveCache()
+
+    @classmethod
+    def findGitRoots(cls, base_dir):
+        # Don't go deeper than git roots, max_search_depth, or into
+        # hidden directories (like .tox or .cache).
+        git_roots = []
+        pending = [(base_dir, 0)]
+        while pending:
+            root, depth = pending.pop()
+            try:
+                with os.scandir(root) as it:
+                    dirs = sorted((e for e in it if e.is_dir()),
+                                  key=lambda e: e.name, reverse=True)
+            except OSError:
                 continue
-            settings = os.path.join(devstack, 'settings')
-            if not (os.path.exists(settings) and os.path.isfile(settings)):
+            if any(e.name == '.git' for e in dirs):
+                git_roots.append(root)
                 continue
-            self.loadDevstackPluginInfo(settings)
+            if depth >= cls.max_search_depth:
+                continue
+            for e in dirs:
+                if not e.name.startswith('.') and not e.is_symlink():
+                    pending.append((e.path, depth + 1))
+        return git_roots
+
+    def loadGitRoot(self, root):
+        settings = os.path.join(root, 'devstack', 'settings')
+        key = get_settings_key(settings)
+        if key is None:
+            return
+        self.settings[settings] = key
+        cached = self._cache.get(settings)
+        if cached is not None and cached['key'] == key:
+            name, reqs = cached['name'], set(cached['requires'])
+        else:
+            name, reqs = self.parseDevstackPluginInfo(settings)
+            self._cache[settings] = dict(key=key, name=name,
+                                         requires=sorted(reqs))
+            self._cache_changed = True
+        self._addPluginInfo(name, reqs)
+
+    def _loadCache(self):
+        if not self._cache_path:
+            return
+        try:
+            with open(self._cache_path) as f:
+                self._cache = json.load(f)
+        except (OSError, ValueError):
+            self._cache = {}
+
+    def _saveCache(self):
+        if not (self._cache_path and self._cache_changed):
+            return
+        tmp = self._cache_path + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(self._cache, f)
+            os.replace(tmp, self._cache_path)
+        except OSError:
+            # The cache is only an optimization
+            pass
 
     define_re = re.compile(r'^define_plugin\s+(\S+).*')
     require_re = re.compile(r'^plugin_requires\s+(\S+)\s+(\S+).*')
-    def loadDevstackPluginInfo(self, fn):
+    def parseDevstackPluginInfo(self, fn):
         name = None
         reqs = set()
         with open(fn) as f:
             for line in f:
-                m = self.define_re.match(line)
-                if m:
-                    name = m.group(1)
-                m = self.require_re.match(line)
-                if m:
-                    if name == m.group(1):
-                        reqs.add(m.group(2))
+                if line.startswith('define_plugin'):
+                    m = self.define_re.match(line)
+                    if m:
+                        name = m.group(1)
+                elif line.startswith('plugin_requires'):
+                    m = self.require_re.match(line)
+                    if m:
+                        if name == m.group(1):
+                            reqs.add(m.group(2))
+        return name, reqs
+
+    def loadDevstackPluginInfo(self, fn):
+        self._addPluginInfo(*self.parseDevstackPluginInfo(fn))
+
+    def _addPluginInfo(self, name, reqs):
+        if name:
+            self._defined_plugins.add(name)
         if name and reqs:
             self._plugin_dependencies[name] = reqs
 
@@ -185,29 +316,18 @@ class PluginGraph(DependencyGraph):
             if dependency == key:
                 continue
             dependencies.add(dependency)
-        try:
-            self.add(key, dependencies)
-        except Exception:
-            del self.plugins[key]
-            raise
+        self.add(key, dependencies)
 
     def getPlugins(self):
-        ret = []
-        keys = sorted(self.plugins.keys())
-        seen = set()
-        for key in keys:
-            dependencies = self.getDependenciesRecursively(key)
-            for plugin in dependencies + [key]:
-                if plugin not in seen:
-                    ret.append((plugin, self.plugins[plugin]))
-                    seen.add(plugin)
-        return ret
+        return [(plugin, self.plugins[plugin])
+                for plugin in self.getOrder(sorted(self.plugins.keys()))]
 
 
 class LocalConf(object):
 
     def __init__(self, localrc, localconf, base_services, services, plugins,
-                 base_dir, projects, project, tempest_plugins):
+                 base_dir, projects, project, tempest_plugins,
+                 plugin_cache=None):
         self.localrc = []
         self.warnings = []
         self.meta_sections = {}
@@ -216,6 +336,9 @@ class LocalConf(object):
         self.projects = projects
         self.project = project
         self.tempest_plugins = tempest_plugins
+        self.plugin_cache = plugin_cache
+        self.plugin_settings = {}
+        self.unresolved_plugins = []
         if services or base_services:
             self.handle_services(base_services, services or {})
         self.handle_localrc(localrc)
@@ -228,7 +351,10 @@ class LocalConf(object):
             self.handle_localconf(localconf)
 
     def handle_plugins(self, plugins):
-        pg = PluginGraph(self.base_dir, plugins)
+        pg = PluginGraph(self.base_dir, plugins, self.projects,
+                         self.plugin_cache)
+        self.plugin_settings = pg.settings
+        self.unresolved_plugins = pg.unresolved
         for k, v in pg.getPlugins():
             if v:
                 self.localrc.append('enable_plugin {} {}'.format(k, v))
@@ -289,7 +415,6 @@ class LocalConf(object):
 
 
     def handle_localconf(self, localconf):
-        print("localconf is : {}", localconf)        
         for phase, phase_data in localconf.items():
             for fn, fn_data in phase_data.items():
                 ms_name = '[[{}|{}]]'.format(phase, fn)
@@ -301,14 +426,128 @@ class LocalConf(object):
                     ms_data.append('')
                 self.meta_sections[ms_name] = ms_data
 
+    def render(self):
+        out = ['[[local|localrc]]\n', '\n'.join(self.localrc), '\n\n']
+        for section, lines in self.meta_sections.items():
+            out.append('{}\n'.format(section))
+            out.append('\n'.join(lines))
+        return ''.join(out)
+
     def write(self, path):
-        with open(path, 'w') as f:
-            f.write('[[local|localrc]]\n')
-            f.write('\n'.join(self.localrc))
-            f.write('\n\n')
-            for section, lines in self.meta_sections.items():
-                f.write('{}\n'.format(section))
-                f.write('\n'.join(lines))
+        # Replace the file at once, so that it is never seen partially
+        # written.
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp, path)
+
+
+class LocalConfCache(object):
+    # Rendered local.conf files, keyed by a hash of the module
+    # arguments they were rendered from.  Each entry also records the
+    # devstack plugin settings that were read and the plugins which
+    # were not found, and is only used as long as those settings are
+    # unchanged and no new ones have appeared where the missing plugins
+    # were searched for.  VERSION is part of the key, and must be
+    # increased whenever a change to this module changes the rendered
+    # output for the same arguments.
+    VERSION = 1
+    args = ('localrc', 'local_conf', 'base_services', 'services',
+            'plugins', 'base_dir', 'projects', 'project', 'tempest_plugins')
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def getKey(self, params):
+        # The order of the dictionaries is kept, since it determines
+        # the order of the output for some of them.
+        data = json.dumps([self.VERSION] +
+                          [params.get(arg) for arg in self.args],
+                          separators=(',', ':'))
+        return hashlib.sha256(data.encode('utf8')).hexdigest()
+
+    def _path(self, key, suffix):
+        return os.path.join(self.cache_dir, key + suffix)
+
+    def get(self, key, path, base_dir=None):
+        # Write the cached local.conf to path, and return the warnings
+        # it was rendered with, or None if it is not in the cache.
+        try:
+            with open(self._path(key, '.json')) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        for settings, settings_key in entry['plugin_settings'].items():
+            if get_settings_key(settings) != settings_key:
+                return None
+        if entry['unresolved'] and base_dir is not None:
+            # Every git root was searched for the missing plugins
+            for root in PluginGraph.findGitRoots(base_dir):
+                settings = os.path.join(root, 'devstack', 'settings')
+                if (settings not in entry['plugin_settings'] and
+                        os.path.exists(settings)):
+                    return None
+        try:
+            # Like LocalConf.write, replace the file at once
+            tmp = path + '.tmp'
+            shutil.copyfile(self._path(key, '.conf'), tmp)
+            os.replace(tmp, path)
+        except OSError:
+            return None
+        return entry['warnings']
+
+    def put(self, key, path, warnings, plugin_settings, unresolved):
+        entry = dict(warnings=warnings, plugin_settings=plugin_settings,
+                     unresolved=unresolved)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # The rendered file goes first, so that an entry is never
+            # found without it.
+            tmp = self._path(key, '.conf.tmp')
+            shutil.copyfile(path, tmp)
+            os.replace(tmp, self._path(key, '.conf'))
+            tmp = self._path(key, '.json.tmp')
+            with open(tmp, 'w') as f:
+                json.dump(entry, f)
+            os.replace(tmp, self._path(key, '.json'))
+        except OSError:
+            # The cache is only an optimization
+            pass
+
+
+def write_local_conf(p):
+    # Returns the result of the module.  Nothing may be printed, since
+    # the result is read from stdout.
+    result = _write_local_conf(p)
+    if p.get('verbose'):
+        with open(p['path']) as f:
+            result['localconf'] = f.read()
+    return result
+
+
+def _write_local_conf(p):
+    cache = key = None
+    if p.get('cache_dir'):
+        cache = LocalConfCache(p['cache_dir'])
+        key = cache.getKey(p)
+        warnings = cache.get(key, p['path'], p.get('base_dir'))
+        if warnings is not None:
+            return dict(warnings=warnings, cache_hit=True, cache_key=key)
+    lc = LocalConf(p.get('localrc'),
+                   p.get('local_conf'),
+                   p.get('base_services'),
+                   p.get('services'),
+                   p.get('plugins'),
+                   p.get('base_dir'),
+                   p.get('projects'),
+                   p.get('project'),
+                   p.get('tempest_plugins'),
+                   p.get('plugin_cache'))
+    lc.write(p['path'])
+    if cache is not None:
+        cache.put(key, p['path'], lc.warnings, lc.plugin_settings,
+                  lc.unresolved_plugins)
+    return dict(warnings=lc.warnings, cache_hit=False, cache_key=key)
 
 
 def main():
@@ -324,22 +563,13 @@ def main():
             projects=dict(type='dict'),
             project=dict(type='dict'),
             tempest_plugins=dict(type='list'),
+            plugin_cache=dict(type='path'),
+            cache_dir=dict(type='path'),
+            verbose=dict(type='bool', default=False),
         )
     )
 
-    p = module.params
-    lc = LocalConf(p.get('localrc'),
-                   p.get('local_conf'),
-                   p.get('base_services'),
-                   p.get('services'),
-                   p.get('plugins'),
-                   p.get('base_dir'),
-                   p.get('projects'),
-                   p.get('project'),
-                   p.get('tempest_plugins'))
-    lc.write(p['path'])
-
-    module.exit_json(warnings=lc.warnings)
+    module.exit_json(**write_local_conf(module.params))
 
 
 try:
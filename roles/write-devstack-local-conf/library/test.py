@@ -14,12 +14,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import contextlib
+import io
 import os
 import shutil
 import tempfile
+import time
 import unittest
+from unittest import mock
 
-from devstack_local_conf import LocalConf
+from devstack_local_conf import LocalConf, LocalConfCache, PluginGraph
+from devstack_local_conf import write_local_conf
 from collections import OrderedDict
 
 class TestDevstackLocalConf(unittest.TestCase):
@@ -245,6 +250,227 @@ class TestDevstackLocalConf(unittest.TestCase):
             lc = self._init_localconf(p)
             lc.write(p['path'])
 
+    def test_var_circular_deps(self):
+        "Test that variables with circular dependencies fail"
+        localrc = {'A': '${B}', 'B': '$A', 'C': '$A', 'D': '1'}
+        p = dict(localrc=localrc,
+                 base_services=[],
+                 base_dir='./test',
+                 path=os.path.join(self.tmpdir, 'test.local.conf'))
+        with self.assertRaisesRegex(Exception,
+                                    'Dependency cycle detected in A, B, C'):
+            self._init_localconf(p)
+
+    def test_large_localrc(self):
+        "Test (and time) a localrc with thousands of dependent variables"
+        localrc = {}
+        for i in range(5000):
+            deps = set([i // 2, i // 3, i - 1]) - set([i])
+            localrc['VAR{}'.format(i)] = ' '.join(
+                '${{VAR{}}}'.format(d) for d in deps if d >= 0)
+        p = dict(localrc=localrc,
+                 base_services=[],
+                 base_dir='./test',
+                 path=os.path.join(self.tmpdir, 'test.local.conf'))
+        start = time.monotonic()
+        lc = self._init_localconf(p)
+        print("Ordered {} variables in {:.3f}s".format(
+            len(localrc), time.monotonic() - start))
+        names = [line.split('=')[0] for line in lc.localrc]
+        self.assertEqual(sorted(localrc.keys()), sorted(names))
+        # The variables are listed in sorted order, each one preceded
+        # by those of its dependencies which were not listed yet.
+        self.assertEqual(['VAR0', 'VAR1'], names[:2])
+        self.assertLess(names.index('VAR5'), names.index('VAR10'))
+
+    def test_deep_localrc(self):
+        "Test a localrc with a long chain of variable references"
+        localrc = {'VAR0': 'value'}
+        for i in range(1, 3000):
+            localrc['VAR{}'.format(i)] = '${{VAR{}}}'.format(i - 1)
+        p = dict(localrc=localrc,
+                 base_services=[],
+                 base_dir='./test',
+                 path=os.path.join(self.tmpdir, 'test.local.conf'))
+        lc = self._init_localconf(p)
+        names = [line.split('=')[0] for line in lc.localrc]
+        self.assertEqual(len(localrc), len(names))
+        # Each chain is only walked up to the part already listed
+        expected = (['VAR0', 'VAR1'] +
+                    ['VAR{}'.format(i) for i in range(9, 1, -1)] +
+                    ['VAR10'] +
+                    ['VAR{}'.format(i) for i in range(99, 10, -1)] +
+                    ['VAR100', 'VAR999'])
+        self.assertEqual(expected, names[:len(expected)])
+
+    def _make_plugin(self, path, name, requires=None):
+        os.makedirs(os.path.join(self.tmpdir, path, 'devstack'))
+        os.makedirs(os.path.join(self.tmpdir, path, '.git'))
+        with open(os.path.join(self.tmpdir, path, '.git', 'HEAD'), 'w') as f:
+            f.write('0123456789abcdef0123456789abcdef01234567\n')
+        with open(os.path.join(
+                self.tmpdir, path, 'devstack', 'settings'), 'w') as f:
+            f.write('define_plugin {}\n'.format(name))
+            if requires:
+                f.write('plugin_requires {} {}\n'.format(name, requires))
+
+    def test_plugin_deps_from_projects(self):
+        "Test that plugins are found in the projects without a search"
+        self._make_plugin('foo-plugin', 'foo')
+        self._make_plugin('bar-plugin', 'bar', 'foo')
+        projects = {
+            'opendev.org/x/foo-plugin': {'short_name': 'foo-plugin'},
+            'opendev.org/x/bar-plugin': {'short_name': 'bar-plugin'},
+        }
+        plugins = OrderedDict([
+            ('bar', 'https://opendev.org/x/bar-plugin'),
+            ('foo', 'https://opendev.org/x/foo-plugin'),
+        ])
+        with mock.patch.object(PluginGraph, 'findGitRoots') as find:
+            pg = PluginGraph(self.tmpdir, plugins, projects)
+        find.assert_not_called()
+        self.assertEqual(['foo', 'bar'], [k for k, v in pg.getPlugins()])
+
+        # A plugin outside of the projects is searched for, but not in
+        # hidden directories or too deep
+        self._make_plugin('extra/baz-plugin', 'baz', 'bar')
+        self._make_plugin('.tox/py3/src/qux-plugin', 'qux')
+        self._make_plugin('a/b/c/quux-plugin', 'quux')
+        pg = PluginGraph(self.tmpdir, dict(plugins, baz='baz'), projects)
+        self.assertEqual(['foo', 'bar', 'baz'],
+                         [k for k, v in pg.getPlugins()])
+        self.assertEqual(
+            [os.path.join(self.tmpdir, 'bar-plugin'),
+             os.path.join(self.tmpdir, 'extra', 'baz-plugin'),
+             os.path.join(self.tmpdir, 'foo-plugin')],
+            pg.findGitRoots(self.tmpdir))
+
+    def test_plugin_cache(self):
+        "Test that plugin settings are only parsed when they change"
+        self._make_plugin('foo-plugin', 'foo')
+        self._make_plugin('bar-plugin', 'bar', 'foo')
+        cache = os.path.join(self.tmpdir, 'plugins.json')
+        plugins = OrderedDict([('bar', 'bar'), ('foo', 'foo')])
+        parse = PluginGraph.parseDevstackPluginInfo
+        with mock.patch.object(PluginGraph, 'parseDevstackPluginInfo',
+                               autospec=True, side_effect=parse) as m:
+            pg = PluginGraph(self.tmpdir, plugins, cache_path=cache)
+            self.assertEqual(2, m.call_count)
+            pg = PluginGraph(self.tmpdir, plugins, cache_path=cache)
+            self.assertEqual(2, m.call_count)
+            self.assertEqual(['foo', 'bar'], [k for k, v in pg.getPlugins()])
+            # A new commit checked out
+            with open(os.path.join(self.tmpdir, 'bar-plugin', '.git',
+                                   'HEAD'), 'w') as f:
+                f.write('fedcba9876543210fedcba9876543210fedcba98\n')
+            pg = PluginGraph(self.tmpdir, plugins, cache_path=cache)
+            self.assertEqual(3, m.call_count)
+
+    def test_local_conf_cache(self):
+        "Test that local.conf is reused for the same inputs"
+        self._make_plugin('foo-plugin', 'foo')
+        self._make_plugin('bar-plugin', 'bar', 'foo')
+        p = dict(localrc={'test_localrc': '1'},
+                 base_services=[],
+                 services={'cinder': True},
+                 plugins=OrderedDict([('bar', 'bar'), ('foo', 'foo')]),
+                 base_dir=self.tmpdir,
+                 path=os.path.join(self.tmpdir, 'test.local.conf'),
+                 cache_dir=os.path.join(self.tmpdir, 'cache'))
+        result = write_local_conf(p)
+        self.assertFalse(result['cache_hit'])
+        with open(p['path']) as f:
+            expected = f.read()
+        os.unlink(p['path'])
+
+        with mock.patch('devstack_local_conf.LocalConf') as lc:
+            hit = write_local_conf(p)
+        lc.assert_not_called()
+        self.assertTrue(hit['cache_hit'])
+        self.assertEqual(result['cache_key'], hit['cache_key'])
+        with open(p['path']) as f:
+            self.assertEqual(expected, f.read())
+
+        # A change to the settings of a plugin invalidates the entry
+        settings = os.path.join(self.tmpdir, 'foo-plugin', 'devstack',
+                                'settings')
+        with open(settings, 'a') as f:
+            f.write('plugin_requires foo bar\n')
+        with self.assertRaisesRegex(Exception, 'Dependency cycle'):
+            write_local_conf(p)
+
+        # As do different inputs
+        os.unlink(settings)
+        p['localrc'] = {'test_localrc': '2'}
+        result = write_local_conf(p)
+        self.assertFalse(result['cache_hit'])
+        self.assertNotEqual(hit['cache_key'], result['cache_key'])
+
+        # Or a new version of the module
+        self.assertTrue(write_local_conf(p)['cache_hit'])
+        with mock.patch.object(LocalConfCache, 'VERSION',
+                               LocalConfCache.VERSION + 1):
+            new = write_local_conf(p)
+        self.assertFalse(new['cache_hit'])
+        self.assertNotEqual(result['cache_key'], new['cache_key'])
+
+    def test_local_conf_cache_new_plugin(self):
+        "Test that a plugin which was not found is looked for again"
+        self._make_plugin('foo-plugin', 'foo')
+        p = dict(localrc={'test_localrc': '1'},
+                 base_services=[],
+                 plugins=OrderedDict([('bar', 'bar'), ('foo', 'foo')]),
+                 base_dir=self.tmpdir,
+                 path=os.path.join(self.tmpdir, 'test.local.conf'),
+                 cache_dir=os.path.join(self.tmpdir, 'cache'))
+        self.assertFalse(write_local_conf(p)['cache_hit'])
+        with open(p['path']) as f:
+            self.assertIn('enable_plugin bar bar\nenable_plugin foo foo',
+                          f.read())
+        self.assertTrue(write_local_conf(p)['cache_hit'])
+        self.assertFalse(os.path.exists(p['path'] + '.tmp'))
+
+        # bar shows up, and has to be enabled after foo now
+        self._make_plugin('extra/bar-plugin', 'bar', 'foo')
+        self.assertFalse(write_local_conf(p)['cache_hit'])
+        with open(p['path']) as f:
+            self.assertIn('enable_plugin foo foo\nenable_plugin bar bar',
+                          f.read())
+        self.assertTrue(write_local_conf(p)['cache_hit'])
+
+    def test_write_verbose(self):
+        "Test that local.conf is only returned when verbose"
+        local_conf = {'install':
+                      {'nova.conf':
+                       {'main':
+                        {'test_conf': '2'}}}}
+        p = dict(local_conf=local_conf,
+                 base_services=[],
+                 path=os.path.join(self.tmpdir, 'test.local.conf'))
+        expected = ('[[local|localrc]]\n\n\n'
+                    '[[install|nova.conf]]\n[main]\n'
+                    'test_conf = 2\n')
+        for verbose in (False, True):
+            p['verbose'] = verbose
+            # The module result is read from stdout
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                result = write_local_conf(p)
+            self.assertEqual('', out.getvalue())
+            self.assertEqual(verbose, 'localconf' in result)
+            if verbose:
+                self.assertEqual(expected, result['localconf'])
+        self.assertEqual(['test.local.conf'], os.listdir(self.tmpdir))
+        with open(p['path']) as f:
+            self.assertEqual(expected, f.read())
+
+        # The same goes for a cache hit
+        p['cache_dir'] = os.path.join(self.tmpdir, 'cache')
+        write_local_conf(p)
+        result = write_local_conf(p)
+        self.assertTrue(result['cache_hit'])
+        self.assertEqual(expected, result['localconf'])
+
     def _find_tempest_plugins_value(self, file_path):
         tp = None
         with open(file_path) as f: